@@ -0,0 +1,50 @@
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+
+# my modules
+from models.modules.STConvLSTM2DCell import STConvLSTM2DCell
+
+
+def benchmark(cell_step, inputs, states, repeat):
+    # seconds per timestep of the whole cell step (gates, state update and RefineNet),
+    # after a warm-up call that traces the function
+    step = tf.function(cell_step)
+    step(inputs, states)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        r_d, (r_h, c) = step(inputs, states)
+    r_d.numpy()
+    return (time.perf_counter() - start) / repeat
+
+
+if __name__ == "__main__":
+    # per-step time of the cell with the fused gate convolutions (one input and one recurrent conv, cell.call
+    # without dropout) against the four input and four recurrent convolutions of the split gates, with the
+    # same weights; both include RefineNet, so the speedup is that of a whole step
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--patch_size', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=100)
+    args=parser.parse_args()
+
+    input_dim, filters = 16, 8   # the cell of LFV_conv3D_STCLSTM
+    cell = STConvLSTM2DCell(filters, kernel_size=3, padding='same')
+    cell.build((None, args.patch_size, args.patch_size, input_dim))
+    inputs = tf.random.uniform((args.batch_size, args.patch_size, args.patch_size, input_dim))
+    states = [tf.random.uniform((args.batch_size, args.patch_size, args.patch_size, filters)) for _ in range(2)]
+
+    def fused_step(inputs, states):
+        return cell.call(inputs, states)
+
+    def split_step(inputs, states):
+        return cell.gate_outputs(*cell.split_gates(inputs, states[0]), states[1])
+
+    fused = tf.nest.flatten(fused_step(inputs, states))
+    split = tf.nest.flatten(split_step(inputs, states))
+    print('max difference', max(np.abs(a.numpy() - b.numpy()).max() for a, b in zip(fused, split)))
+    fused_time = benchmark(fused_step, inputs, states, args.repeat)
+    split_time = benchmark(split_step, inputs, states, args.repeat)
+    print(f'split gates {split_time*1e3:.2f} ms/step, fused gates {fused_time*1e3:.2f} ms/step, '
+          f'speedup {split_time/fused_time:.2f}x per cell step')
@@ -0,0 +1,107 @@
+import json
+import os
+import threading
+import numpy as np
+from tensorflow.keras.callbacks import Callback
+
+
+def load_checkpoint(path):
+    # checkpoint.npz written by training_checkpoint -> dict of state, model, optimizer, sampler, np_random
+    with np.load(path) as data:
+        state = json.loads(str(data['state']))
+        model = [data[f'model_{i}'] for i in range(state['model_n'])]
+        optimizer = [data[f'optimizer_{i}'] for i in range(state['optimizer_n'])]
+        sampler = {key[len('sampler_'):]: data[key] for key in data.files if key.startswith('sampler_')}
+        np_random = ('MT19937', data['np_random_keys'], *state['np_random'])
+    return {'state': state, 'model': model, 'optimizer': optimizer, 'sampler': sampler, 'np_random': np_random}
+
+
+def restore_checkpoint(checkpoint, model, sampler=None, best_checkpoint=None):
+    # loads a load_checkpoint() result into the compiled model, its optimizer, the sampler, the
+    # ModelCheckpoint best value and numpy's global RNG
+    model.set_weights(checkpoint['model'])
+    # optimizer slots are created on the first update, so create them to load the saved moments into
+    model.optimizer._create_all_weights(model.trainable_variables)
+    model.optimizer.set_weights(checkpoint['optimizer'])
+    if sampler is not None:
+        sampler.set_state(checkpoint['sampler'])
+    if best_checkpoint is not None and checkpoint['state']['best'] is not None:
+        best_checkpoint.best = checkpoint['state']['best']
+    np.random.set_state(checkpoint['np_random'])
+
+
+class training_checkpoint(Callback):
+    # Saves the full training state to `path` every `every` steps and after every epoch: model and
+    # optimizer weights, epoch and step, the seed of the training batches, sampler state (importance
+    # scores), numpy's global RNG and the best val_loss of best_checkpoint (the ModelCheckpoint of the best weights).
+    # The state is copied at the step and written by a background thread to a temporary file
+    # renamed over the previous checkpoint, so training does not wait for the disk and a crash
+    # during a write leaves the previous checkpoint intact.
+    # Put it after the callbacks that change state at the end of an epoch (importance_scoring).
+    def __init__(self, path, steps_per_epoch, every=1000, seed=None, sampler=None, best_checkpoint=None, start_step=0):
+        # seed: seed of the training batch stream, start_step: step within the first epoch the training starts from (resumed runs)
+        super().__init__()
+        self.path = str(path)
+        self.steps_per_epoch = steps_per_epoch
+        self.every = every
+        self.seed = seed
+        self.sampler = sampler
+        self.best_checkpoint = best_checkpoint
+        self.start_step = start_step
+        self.epoch = 0
+        self.saved_step = None
+        self.writer = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_train_batch_end(self, batch, logs=None):
+        step = self.start_step + batch + 1
+        global_step = self.epoch * self.steps_per_epoch + step
+        if self.saved_step is None:
+            self.saved_step = global_step - 1
+        # the compiled loop reports every steps_per_execution steps
+        if global_step // self.every > self.saved_step // self.every:
+            self.save(self.epoch, step)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.start_step = 0
+        self.save(epoch + 1, 0)
+
+    def on_train_end(self, logs=None):
+        self.wait()
+
+    def save(self, epoch, step):
+        # epoch, step: where the resumed training continues
+        self.saved_step = epoch * self.steps_per_epoch + step
+        model_weights = self.model.get_weights()
+        optimizer_weights = self.model.optimizer.get_weights()
+        np_random = np.random.get_state()
+        best = getattr(self.best_checkpoint, 'best', None)
+        state = {'epoch': epoch, 'step': step, 'global_step': self.saved_step, 'seed': self.seed,
+                 'best': None if best is None or not np.isfinite(best) else float(best),
+                 'model_n': len(model_weights), 'optimizer_n': len(optimizer_weights),
+                 'np_random': [int(np_random[2]), int(np_random[3]), float(np_random[4])]}
+        arrays = {f'model_{i}': weight for i, weight in enumerate(model_weights)}
+        arrays.update({f'optimizer_{i}': weight for i, weight in enumerate(optimizer_weights)})
+        if self.sampler is not None:
+            arrays.update({f'sampler_{key}': np.copy(value) for key, value in self.sampler.get_state().items()})
+        arrays['np_random_keys'] = np_random[1]
+        arrays['state'] = np.array(json.dumps(state))
+        # one write at a time, in order
+        self.wait()
+        self.writer = threading.Thread(target=self.write, args=(arrays,), daemon=True)
+        self.writer.start()
+
+    def write(self, arrays):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def wait(self):
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
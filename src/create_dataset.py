@@ -1,55 +1,313 @@
 import numpy as np
-import pathlib, argparse
+import pathlib, argparse, json, os, time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from PIL import Image
 
+# my modules
+from patch_codec import CODECS, encode_patch, decode_patch
+from patch_store import STORE_NAME, SCENE_STORE_NAME, open_arrays, patch_grid, write_manifest, EncodedPartWriter
+from patch_store import create_patch_store, write_patch_window, write_encoded_patch_store, remove_parts, create_scene_store, write_scene_chunk
+
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--frame_length', '-fl', type=int, default=5)
+parser.add_argument('--layout', choices=['patch', 'scene'], default='patch',
+                    help='patch: store every sliding window patch, scene: store every frame once and cut patches when reading')
+parser.add_argument('--codec', choices=CODECS, default='raw',
+                    help='patch record codec of the patch layout, raw stores are memory-mapped')
+parser.add_argument('--benchmark_codecs', metavar='SCENE',
+                    help='report bytes and decode time per patch of every codec on SCENE instead of building')
+parser.add_argument('--write_manifest', action='store_true',
+                    help='only (re)write the dataset manifest of the finished scenes')
+parser.add_argument('--workers', '-j', type=int, default=os.cpu_count())
+parser.add_argument('--chunk_size', type=int, default=8,
+                    help='key frames (patch layout) or frames (scene layout) written by one job')
+parser.add_argument('--decode_threads', type=int, default=6,
+                    help='threads decoding the 18 views of a frame in each worker')
+parser.add_argument('--data_root', default=None,
+                    help='output dir (default: ../patch_data_fl{frame_length}); scene stores serve any frame_length, '
+                         'so --write_manifest on an existing scene layout dir only rewrites the manifest')
+parser.add_argument('--streaming', action='store_true',
+                    help='decode one frame at a time into a ring buffer, so memory does not grow with chunk_size')
 
-frame_length = parser.parse_args().frame_length
+args = parser.parse_args()
+frame_length = args.frame_length
+layout = args.layout
+codec = args.codec
+if layout == 'scene' and codec != 'raw':
+    parser.error('the scene layout is always stored raw')
 w_size = 1024
 h_size = 436
 full_data_root = pathlib.Path('../Sintel_LF')
-patch_data_root = pathlib.Path(f'../patch_data_fl{frame_length}')
-
-def create_seq_EPI_patch(save_dir, seq_v, seq_h, seq_disp, patch_size=32, stride=16):
-    save_dir.mkdir(parents=True, exist_ok=True)
-    y_patch_n = (h_size - (patch_size-stride)) // stride
-    x_patch_n = (w_size - (patch_size-stride)) // stride
-    # save patch binary
-    for key_frame_idx in range(len(seq_disp) - (frame_length-1)):
-        numbering = y_patch_n * x_patch_n * key_frame_idx
-        for iy in range(0, y_patch_n):
-            for ix in range(0, x_patch_n):
-                np.savez_compressed(save_dir / f'{numbering:05}.npz', 
-                        v=seq_v[      key_frame_idx:key_frame_idx+frame_length, :, iy*stride:iy*stride+patch_size, ix*stride:ix*stride+patch_size],
-                        h=seq_h[      key_frame_idx:key_frame_idx+frame_length, :, iy*stride:iy*stride+patch_size, ix*stride:ix*stride+patch_size],
-                        disp=seq_disp[key_frame_idx:key_frame_idx+frame_length,    iy*stride:iy*stride+patch_size, ix*stride:ix*stride+patch_size])
-                numbering += 1
-    # save full binary
-    np.savez_compressed(save_dir / 'full.npz', v=seq_v, h=seq_h, disp=seq_disp)
+patch_data_root = pathlib.Path(args.data_root or f'../patch_data_fl{frame_length}')
+manifest_path = patch_data_root / 'build_manifest.json'
+
+
+decode_pool = None
+
+def read_view(img_path, out):
+    img = Image.open(img_path)
+    if img.size != (w_size, h_size):
+        img = img.resize((w_size, h_size))
+    out[:] = np.asarray(img)
+
+
+def decode_frame(disp_path, out_v, out_h, out_disp):
+    # PNG decoding releases the GIL, so the 18 views of a frame are decoded in threads
+    global decode_pool
+    if decode_pool is None:
+        decode_pool = ThreadPoolExecutor(args.decode_threads)
+    futures = []
+    for iy in range(9):
+        img_path = str(disp_path).replace('04_04', f'{iy:02}_04').replace('npy', 'png')
+        futures.append(decode_pool.submit(read_view, img_path, out_v[iy]))
+    for ix in range(9):
+        img_path = str(disp_path).replace('04_04', f'04_{ix:02}').replace('npy', 'png')
+        futures.append(decode_pool.submit(read_view, img_path, out_h[ix]))
+    disp = np.load(disp_path)
+    if disp.shape != (h_size, w_size):
+        disp = np.asarray(Image.fromarray(disp).resize((w_size, h_size)))
+    out_disp[:] = disp
+    for future in futures:
+        future.result()
+
+
+def load_frames(disp_paths):
+    seq_v = np.zeros((len(disp_paths), 9, h_size, w_size, 3), dtype=np.uint8)
+    seq_h = np.zeros((len(disp_paths), 9, h_size, w_size, 3), dtype=np.uint8)
+    seq_disp = np.zeros((len(disp_paths), h_size, w_size), dtype=np.float32)
+    for i, disp_path in enumerate(disp_paths):
+        decode_frame(disp_path, seq_v[i], seq_h[i], seq_disp[i])
+    return seq_v, seq_h, seq_disp
+
+
+def stream_frames(disp_paths, depth):
+    # decode one frame at a time into a ring buffer `depth` frames deep,
+    # frame i is in slot i % depth until frame i + depth is decoded
+    ring_v = np.zeros((depth, 9, h_size, w_size, 3), dtype=np.uint8)
+    ring_h = np.zeros((depth, 9, h_size, w_size, 3), dtype=np.uint8)
+    ring_disp = np.zeros((depth, h_size, w_size), dtype=np.float32)
+    for i, disp_path in enumerate(disp_paths):
+        slot = i % depth
+        decode_frame(disp_path, ring_v[slot], ring_h[slot], ring_disp[slot])
+        yield i, (ring_v, ring_h, ring_disp)
+
+
+def encode_key_frame(frames_v, frames_h, frames_disp, patch_size=32, stride=16):
+    # frames_*: the frame_length frames of one key frame window
+    _, y_patch_n, x_patch_n = patch_grid(frame_length, h_size, w_size, frame_length, patch_size, stride)
+    records = []
+    for iy in range(y_patch_n):
+        for ix in range(x_patch_n):
+            y = slice(iy*stride, iy*stride+patch_size)
+            x = slice(ix*stride, ix*stride+patch_size)
+            records.append(encode_patch(codec, [frame[:, y, x] for frame in frames_h],
+                                               [frame[:, y, x] for frame in frames_v],
+                                               [frame[y, x] for frame in frames_disp]))
+    return records
+
+
+def build_chunk(store_path, disp_paths, start, stop, part_path=None):
+    # start, stop: key frames for the patch layout, frames for the scene layout
+    if layout == 'patch':
+        disp_paths = disp_paths[start:stop+frame_length-1]
+    else:
+        disp_paths = disp_paths[start:stop]
+    if part_path is None:
+        header, arrays = open_arrays(store_path, mode='r+')
+    else:
+        part = EncodedPartWriter(part_path)
+    # with streaming, peak memory is frame_length frames whatever the scene or chunk length
+    if args.streaming:
+        depth = frame_length if layout == 'patch' else 1
+    else:
+        depth = len(disp_paths)
+    timing = {'decode': 0., 'encode': 0., 'write': 0.}
+    t = time.perf_counter()
+    for i, (ring_v, ring_h, ring_disp) in stream_frames(disp_paths, depth):
+        timing['decode'] += time.perf_counter() - t
+        if layout == 'scene':
+            t = time.perf_counter()
+            slot = slice(i % depth, i % depth + 1)
+            write_scene_chunk(header, arrays, ring_v[slot], ring_h[slot], ring_disp[slot], frame_start=start+i)
+            timing['write'] += time.perf_counter() - t
+        elif i >= frame_length-1:
+            # emit the key frame as soon as its window is complete
+            key_frame_idx = i - (frame_length-1)
+            first_slot = key_frame_idx % depth
+            if part_path is None:
+                t = time.perf_counter()
+                write_patch_window(header, arrays, ring_v, ring_h, ring_disp,
+                                   key_frame_idx=start+key_frame_idx, first_slot=first_slot, depth=depth)
+                timing['write'] += time.perf_counter() - t
+            else:
+                t = time.perf_counter()
+                slots = [(first_slot + n) % depth for n in range(frame_length)]
+                records = encode_key_frame([ring_v[slot] for slot in slots], [ring_h[slot] for slot in slots],
+                                           [ring_disp[slot] for slot in slots])
+                timing['encode'] += time.perf_counter() - t
+                t = time.perf_counter()
+                part.write(records)
+                timing['write'] += time.perf_counter() - t
+        t = time.perf_counter()
+    t = time.perf_counter()
+    if part_path is None:
+        for array in arrays.values():
+            array.flush()
+    else:
+        part.close()
+    timing['write'] += time.perf_counter() - t
+    timing['frames'] = len(disp_paths)
+    return timing
+
+
+def benchmark_codecs(scene_name, patch_n=256, patch_size=32):
+    disp_paths = sorted((full_data_root / scene_name / '04_04').glob('*.npy'))[:frame_length]
+    seq_v, seq_h, seq_disp = load_frames(disp_paths)
+    rng = np.random.RandomState(0)
+    ys = rng.randint(0, h_size - patch_size, patch_n)
+    xs = rng.randint(0, w_size - patch_size, patch_n)
+    patches = [(seq_h[:, :, y:y+patch_size, x:x+patch_size], seq_v[:, :, y:y+patch_size, x:x+patch_size],
+                seq_disp[:, y:y+patch_size, x:x+patch_size]) for y, x in zip(ys, xs)]
+    out_h, out_v, out_disp = [np.empty_like(array) for array in patches[0]]
+    raw_bytes = sum(array.nbytes for array in patches[0])
+    print(f'{scene_name}: {patch_n} patches of {frame_length} frames, {raw_bytes} bytes/patch uncompressed')
+    for name in CODECS:
+        records = [encode_patch(name, *patch) for patch in patches]
+        t = time.perf_counter()
+        for record in records:
+            decode_patch(name, record, out_h, out_v, out_disp)
+        elapsed = time.perf_counter() - t
+        patch_bytes = np.mean([len(record) for record in records])
+        print(f'{name:>6}: {patch_bytes:10.0f} bytes/patch ({raw_bytes / patch_bytes:5.2f}x), '
+              f'decode {elapsed / patch_n * 1e6:8.1f} us/patch')
+
+
+def load_manifest():
+    config = {'layout': layout, 'codec': codec, 'frame_length': frame_length, 'chunk_size': args.chunk_size}
+    if layout == 'scene':
+        # scene stores hold whole frames, the window length is only chosen when reading
+        del config['frame_length']
+    if not manifest_path.exists():
+        return {**config, 'scenes': {}}
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    for key, value in config.items():
+        if manifest[key] != value:
+            raise Exception(f'{manifest_path} was built with {key}={manifest[key]}, but receive {value}. '
+                            f'Use the same settings to resume, or remove it to start over.')
+    return manifest
+
+
+def save_manifest(manifest):
+    # write then rename, so an interrupted run never leaves a broken manifest
+    tmp_path = manifest_path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+def part_path(scene_name, chunk_idx):
+    return patch_data_root / scene_name / f'{STORE_NAME}.part{chunk_idx:05}'
+
+
+def finalize_scene(manifest, scene_name):
+    # encoded chunks are written to part files and joined once the whole scene is done;
+    # the store only appears when complete, so if it exists an interrupted run already joined the
+    # parts and died before removing them or recording it
+    entry = manifest['scenes'][scene_name]
+    store_path = patch_data_root / scene_name / STORE_NAME
+    part_paths = [part_path(scene_name, chunk_idx) for chunk_idx in range(entry['chunk_n'])]
+    if store_path.exists():
+        remove_parts(part_paths)
+    else:
+        write_encoded_patch_store(store_path, part_paths, entry['frame_n'], h_size, w_size, codec=codec,
+                                  frame_length=frame_length, patch_size=32, stride=16)
+    entry['finalized'] = True
+    save_manifest(manifest)
+
+
+def write_dataset_manifest(manifest):
+    scene_names = sorted(scene_name for scene_name, entry in manifest['scenes'].items()
+                            if len(entry['done']) == entry['chunk_n'] and entry['finalized'])
+    write_manifest(patch_data_root, scene_names, frame_length=frame_length, patch_size=32, stride=16)
+    print(f'wrote the manifest of {len(scene_names)} scenes')
+
 
 def main():
-    for scene in full_data_root.glob('**/04_04'):
-        center_disp_list = [p for p in scene.glob('*.npy')]
-        scene_frame_n = len(center_disp_list)
-        # prepare all data
-        seq_v = np.zeros((scene_frame_n, 9, h_size, w_size, 3), dtype=np.uint8)
-        seq_h = np.zeros((scene_frame_n, 9, h_size, w_size, 3), dtype=np.uint8)
-        seq_disp = np.zeros((scene_frame_n, h_size, w_size), dtype=np.float32)
-        for i, disp_path in enumerate(center_disp_list):
-            seq_disp[i] = np.asarray(Image.fromarray(np.load(disp_path)).resize((w_size, h_size)))
-            for iy in range(9):
-                img_path = str(disp_path).replace('04_04', f'{iy:02}_04').replace('npy', 'png')
-                seq_v[i, iy] = np.asarray(Image.open(img_path).resize((w_size, h_size)))
-            for ix in range(9):
-                img_path = str(disp_path).replace('04_04', f'04_{ix:02}').replace('npy', 'png')
-                seq_h[i, ix] = np.asarray(Image.open(img_path).resize((w_size, h_size)))
-        # create input patch
-        create_seq_EPI_patch(save_dir=patch_data_root / center_disp_list[0].parent.parent.name, 
-                            seq_v=seq_v, seq_h=seq_h, seq_disp=seq_disp, patch_size=32, stride=16)
-        print(f'done: {center_disp_list[0].parent.parent.name}')
+    if args.benchmark_codecs:
+        benchmark_codecs(args.benchmark_codecs)
+        return
+    patch_data_root.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest()
+    if args.write_manifest:
+        write_dataset_manifest(manifest)
+        return
+    chunk_size = args.chunk_size
+    encoded = layout == 'patch' and codec != 'raw'
+    jobs = []
+    for scene in sorted(full_data_root.glob('**/04_04')):
+        scene_name = scene.parent.name
+        disp_paths = sorted(scene.glob('*.npy'))
+        unit_n = len(disp_paths) - (frame_length-1) if layout == 'patch' else len(disp_paths)
+        if unit_n <= 0:
+            print(f'skip: {scene_name} has only {len(disp_paths)} frames')
+            continue
+        store_path = patch_data_root / scene_name / (STORE_NAME if layout == 'patch' else SCENE_STORE_NAME)
+        if scene_name not in manifest['scenes']:
+            if layout == 'scene':
+                create_scene_store(store_path, len(disp_paths), h_size, w_size)
+            elif not encoded:
+                create_patch_store(store_path, len(disp_paths), h_size, w_size,
+                                   frame_length=frame_length, patch_size=32, stride=16)
+            else:
+                store_path.parent.mkdir(parents=True, exist_ok=True)
+                # a store of an earlier build would pass for the finalized one
+                if store_path.exists():
+                    os.remove(store_path)
+            manifest['scenes'][scene_name] = {'frame_n': len(disp_paths), 'chunk_n': (unit_n + chunk_size - 1) // chunk_size,
+                                              'done': [], 'finalized': not encoded}
+            save_manifest(manifest)
+        entry = manifest['scenes'][scene_name]
+        if len(entry['done']) == entry['chunk_n'] and not entry['finalized']:
+            finalize_scene(manifest, scene_name)
+        for chunk_idx in range(entry['chunk_n']):
+            if chunk_idx not in entry['done']:
+                start = chunk_idx * chunk_size
+                job_part_path = part_path(scene_name, chunk_idx) if encoded else None
+                jobs.append((scene_name, chunk_idx, (store_path, disp_paths, start, min(start + chunk_size, unit_n), job_part_path)))
+    print(f'{len(jobs)} chunks to build ({sum(len(e["done"]) for e in manifest["scenes"].values())} already done)')
+
+    # build chunks
+    total = {'decode': 0., 'encode': 0., 'write': 0., 'frames': 0}
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(args.workers) as executor:
+        futures = {executor.submit(build_chunk, *job_args): (scene_name, chunk_idx)
+                    for scene_name, chunk_idx, job_args in jobs}
+        for future in as_completed(futures):
+            scene_name, chunk_idx = futures[future]
+            timing = future.result()
+            for key in total:
+                total[key] += timing[key]
+            entry = manifest['scenes'][scene_name]
+            entry['done'].append(chunk_idx)
+            save_manifest(manifest)
+            print(f'chunk {chunk_idx+1}/{entry["chunk_n"]} of {scene_name}: '
+                  f'decode {timing["decode"]:.1f}s ({timing["frames"] / max(timing["decode"], 1e-9):.2f} frames/s), '
+                  f'encode {timing["encode"]:.1f}s, write {timing["write"]:.1f}s')
+            if len(entry['done']) == entry['chunk_n']:
+                if not entry['finalized']:
+                    finalize_scene(manifest, scene_name)
+                print(f'done: {scene_name}')
+
+    # per-stage timing (stage times are summed over workers)
+    elapsed = time.perf_counter() - start_time
+    print(f'built {len(jobs)} chunks in {elapsed:.1f}s with {args.workers} workers')
+    print(f'decode: {total["decode"]:.1f}s ({total["frames"] / max(total["decode"], 1e-9):.2f} frames/s per worker)')
+    print(f'encode: {total["encode"]:.1f}s')
+    print(f'write:  {total["write"]:.1f}s')
+    write_dataset_manifest(manifest)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
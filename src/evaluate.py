@@ -5,7 +5,9 @@ from pathlib import Path
 # my modules
 from models import LFI_conv3D, LFV_conv3D_STCLSTM
 from mygenerator import test_generator
+from mydataset import input_dataset
 from metrics import calc_metrics
+from inference import window_estimator, tiled_estimator
 
 
 # predicted patch video -> full video
@@ -23,6 +25,10 @@ def create_fullmap(patches):
         px = ix*stride_size
         py = iy*stride_size
         fullmap[:, py:py+patch_size, px:px+patch_size] += patch
+    return average_overlap(fullmap)
+
+
+def average_overlap(fullmap):
     # divide the area where multiple patches overlap to obtain the average value
     fullmap[:,  stride_size:-stride_size,  stride_size:-stride_size] /= 4  # center
     fullmap[:,  stride_size:-stride_size,             : stride_size] /= 2  # top center
@@ -32,7 +38,99 @@ def create_fullmap(patches):
     return np.float32(fullmap)
 
 
-def evaluate_model(model_weights_path, test_list):
+def write_window(save_dir, csv_path, scene_name, frame_n, fullmap_pred, fullmap_gt):
+    save_name = save_dir / f"{scene_name}_{frame_n:03}.npz"
+    np.savez_compressed(save_name, pred=fullmap_pred, gt=fullmap_gt)
+    print('saved:', save_name)
+    # metrics output
+    metrics_dict = calc_metrics(fullmap_pred, fullmap_gt)
+    with open(csv_path, 'a', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([scene_name, *metrics_dict.values()])
+
+
+def evaluate_feature_cache(model, test_list, save_dir, csv_path, tile_batch=64, window_block=8):
+    # same windows and outputs as the patch batches of test_generator, but the 3D conv branches run
+    # once per (frame, tile) through window_estimator instead of once per window containing the frame.
+    # The windows of a scene go in blocks of window_block key frames: for every batch of tiles the
+    # windows of the block run in key frame order and their predictions are accumulated into full
+    # maps, written once the last tile batch is done. So only window_block maps are held instead of
+    # the scene's, and the features of the frame_length-1 frames a block shares with the next are computed again.
+    test_data = test_generator(test_list)
+    estimator = window_estimator(model, frame_length)
+    h = np.empty((tile_batch, 1, 9, patch_size, patch_size, 3), dtype=np.uint8)
+    v = np.empty_like(h)
+    disp = np.empty((tile_batch, 1, patch_size, patch_size), dtype=np.float32)
+    for scene_name, store in zip(test_data.scene_names, test_data.stores):
+        key_frame_n = store.shape[0]
+        tiles = [(iy, ix) for iy in range(y_patch_n) for ix in range(x_patch_n)]
+        for block_start in range(0, key_frame_n, window_block):
+            block = range(block_start, min(block_start + window_block, key_frame_n))
+            fullmaps_pred = np.zeros((len(block), frame_length, 432, 1024), dtype=np.float32)
+            frames_gt = np.zeros((len(block) + frame_length - 1, 432, 1024), dtype=np.float32)
+
+            for begin in range(0, len(tiles), tile_batch):
+                batch_tiles = tiles[begin:begin+tile_batch]
+                n = len(batch_tiles)
+
+                def read_frame(frame):
+                    # the frame from a window that contains it
+                    key_frame = min(frame, key_frame_n - 1)
+                    for i, (iy, ix) in enumerate(batch_tiles):
+                        store.read((key_frame, iy, ix), h[i], v[i], disp[i], start=frame - key_frame)
+                    for i, (iy, ix) in enumerate(batch_tiles):
+                        frames_gt[frame - block_start, iy*stride_size:iy*stride_size+patch_size, ix*stride_size:ix*stride_size+patch_size] += disp[i, 0]
+                    return h[:n, 0], v[:n, 0]
+
+                estimator.reset()
+                for key_frame in block:
+                    pred = estimator(key_frame, read_frame)
+                    for i, (iy, ix) in enumerate(batch_tiles):
+                        fullmaps_pred[key_frame - block_start, :, iy*stride_size:iy*stride_size+patch_size, ix*stride_size:ix*stride_size+patch_size] += pred[i]
+
+            frames_gt = average_overlap(frames_gt)
+            for key_frame in block:
+                write_window(save_dir, csv_path, scene_name, key_frame, average_overlap(fullmaps_pred[key_frame - block_start]),
+                             frames_gt[key_frame - block_start:key_frame - block_start + frame_length])
+
+
+def evaluate_full_frame(model, test_list, save_dir, csv_path, memory_bytes=2**30):
+    # windows of full 432x1024 frames (assembled from the test patches) run through tiled_estimator
+    # in halo tiles that fit memory_bytes, instead of overlapping 32x32 patches each padded at its border;
+    # the predictions match the patch path within tolerance, not exactly (no patch borders, window mean)
+    test_data = test_generator(test_list)
+    estimator = tiled_estimator(model, frame_length, memory_bytes)
+    print(f'tiles of {estimator.tile_size}x{estimator.tile_size} with a halo of {estimator.halo} pixels')
+    h = np.empty((1, 9, patch_size, patch_size, 3), dtype=np.uint8)
+    v = np.empty_like(h)
+    disp = np.empty((1, patch_size, patch_size), dtype=np.float32)
+    for scene_name, store in zip(test_data.scene_names, test_data.stores):
+        key_frame_n = store.shape[0]
+        frames = {}
+
+        def read_frame(frame):
+            # the frame from a window that contains it, every patch written over its overlaps
+            key_frame = min(frame, key_frame_n - 1)
+            frame_h = np.empty((9, 432, 1024, 3), dtype=np.uint8)
+            frame_v = np.empty_like(frame_h)
+            frame_gt = np.empty((432, 1024), dtype=np.float32)
+            for iy in range(y_patch_n):
+                for ix in range(x_patch_n):
+                    store.read((key_frame, iy, ix), h, v, disp, start=frame - key_frame)
+                    py, px = iy*stride_size, ix*stride_size
+                    frame_h[:, py:py+patch_size, px:px+patch_size] = h[0]
+                    frame_v[:, py:py+patch_size, px:px+patch_size] = v[0]
+                    frame_gt[py:py+patch_size, px:px+patch_size] = disp[0]
+            return frame_h, frame_v, frame_gt
+
+        for key_frame in range(key_frame_n):
+            window = range(key_frame, key_frame + frame_length)
+            frames = {frame: frames[frame] if frame in frames else read_frame(frame) for frame in window}
+            seq_h, seq_v, gt = (np.stack(arrays) for arrays in zip(*(frames[frame] for frame in window)))
+            write_window(save_dir, csv_path, scene_name, key_frame, estimator(seq_h, seq_v), gt)
+
+
+def evaluate_model(model_weights_path, test_list, tf_data=False, feature_cache=False, full_frame=False, memory_gb=1.0):
     # load model weights
     if 'baseline' in model_weights_path:
         model = LFI_conv3D.build_model()
@@ -55,15 +153,26 @@ def evaluate_model(model_weights_path, test_list):
         writer.writerow(['scene_name', *[metric for metric in metrics_dict.keys()]])
 
     # evaluate
-    test_gen = test_generator(test_list)
+    if feature_cache:
+        evaluate_feature_cache(model, test_list, save_dir, csv_path)
+        return
+    if full_frame:
+        evaluate_full_frame(model, test_list, save_dir, csv_path, int(memory_gb * 2**30))
+        return
+    if tf_data:
+        test_data = input_dataset(test_list, frame_length)
+        test_flow = ((list(inputs), gt, [test_data.scene_names[i] for i in scenes])
+                     for inputs, gt, scenes in test_data.build(mode='test').as_numpy_iterator())
+    else:
+        test_flow = test_generator(test_list).flow_from_directory()
     preds = []
     gts = []
     scene = {'name':'', 'frame_n':0}
-    for inputs, gt, scenes in test_gen.flow_from_directory():
+    for inputs, gt, scenes in test_flow:
         pred = model.predict(inputs)
         for i, scene_name in enumerate(scenes):
             preds.append(pred[i])
-            gts.append(gt[i])
+            gts.append(np.copy(gt[i]))   # gt is a reused batch buffer
             if len(preds) == x_patch_n*y_patch_n:
                 fullmap_pred = create_fullmap(preds)
                 fullmap_gt = create_fullmap(gts)
@@ -71,17 +180,10 @@ def evaluate_model(model_weights_path, test_list):
                 if not scene['name'] == scene_name:
                     scene['frame_n'] = 0
                 scene['name'] = scene_name
-                save_name = save_dir / f"{scene['name']}_{scene['frame_n']:03}.npz"
-                np.savez_compressed(save_name, pred=fullmap_pred, gt=fullmap_gt)
-                print('saved:', save_name)
+                write_window(save_dir, csv_path, scene['name'], scene['frame_n'], fullmap_pred, fullmap_gt)
                 scene['frame_n'] += 1
                 preds = []
                 gts = []
-                # metrics output
-                metrics_dict = calc_metrics(fullmap_pred, fullmap_gt)
-                with open(csv_path, 'a', newline='') as f:
-                    writer = csv.writer(f)
-                    writer.writerow([scene_name, *metrics_dict.values()])
 
 
 if __name__ == "__main__":
@@ -89,6 +191,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('model_weights_path')
     parser.add_argument('--test_list', default='../patch_data_fl5/test_data.txt')
+    parser.add_argument('--tf_data', action='store_true', help='load the test data with the tf.data pipeline (mydataset.py)')
+    parser.add_argument('--feature_cache', action='store_true', help='run the 3D conv branches once per frame and tile (inference.py)')
+    parser.add_argument('--full_frame', action='store_true', help='run full frames in halo tiles (inference.py)')
+    parser.add_argument('--memory_gb', type=float, default=1.0, help='activation memory per tile of --full_frame')
     args=parser.parse_args()
 
-    evaluate_model(model_weights_path=args.model_weights_path, test_list=args.test_list)
\ No newline at end of file
+    evaluate_model(model_weights_path=args.model_weights_path, test_list=args.test_list, tf_data=args.tf_data,
+                   feature_cache=args.feature_cache, full_frame=args.full_frame, memory_gb=args.memory_gb)
\ No newline at end of file
@@ -0,0 +1,218 @@
+import argparse, collections, time
+import numpy as np
+import tensorflow as tf
+from pathlib import Path
+from tensorflow.keras.layers import Input, Concatenate, Conv2D, TimeDistributed
+from tensorflow.keras.models import Model
+
+# my modules
+from models import LFV_conv3D_STCLSTM
+from patch_store import SceneStore, SCENE_STORE_NAME
+
+
+def branch_layers(model):
+    # layers of the h and v branches after their mean subtraction (zero padding, Conv3D, squeeze)
+    return [model.get_layer(f'shared_3Dconv_branch_{axis}').layer.layers[2:] for axis in 'hv']
+
+
+def run_branch(x, layers, mean=None):
+    # x: (batch, angle, height, width, channel) tiles of one frame -> (batch, height, width, 64)
+    # the branch subtracts the mean over the batch, i.e. over the frame's tiles here, or the given (channel,) mean
+    if mean is None:
+        mean = tf.reduce_mean(x, axis=(0, 1, 2, 3))
+    x = x - mean
+    for layer in layers:
+        x = layer(x)
+    return x
+
+
+def head_model(model):
+    # the model after the branches: (batch, frame, height, width, 128) concatenated h, v features -> disparity
+    layers = model.layers
+    start = [i for i, layer in enumerate(layers) if isinstance(layer, Concatenate)][0] + 1
+    inputs = Input(shape=(None, None, None, 128))
+    x = inputs
+    for layer in layers[start:]:
+        x = layer(x)
+    return Model(inputs=inputs, outputs=x)
+
+
+def as_float(h, v):
+    if h.dtype == np.uint8:
+        return h.astype(np.float32) / 255.0, v.astype(np.float32) / 255.0
+    return h, v
+
+
+class stream_estimator():
+    # Streaming inference of LFV_conv3D_STCLSTM: takes one light-field frame at a time and returns its
+    # disparity at once, carrying the recurrent state [r_h, c] of every stream across calls, so each
+    # frame runs the 3D conv branches and the recurrence once instead of once per sliding window.
+    #   stream  any hashable id, e.g. one per video; reset(stream) at scene cuts starts it from zero state
+    # The branches subtract the mean of their input over the batch (the frames of a window in training);
+    # here it is the mean of the current frame of the stream (over all its tiles), computed before the branch layers.
+    # (ConvRNN2D's own stateful mode needs a fixed batch size and one state for all callers, so the
+    # cell is stepped directly.)
+    def __init__(self, model_weights_path=None, model=None):
+        if model is None:
+            model = LFV_conv3D_STCLSTM.build_model()
+            model.load_weights(model_weights_path)
+        self.model = model
+        self.branch_layers = branch_layers(model)
+        self.conv_layers = [layer for layer in model.layers if isinstance(layer, TimeDistributed) and isinstance(layer.layer, Conv2D)]
+        self.cell = model.get_layer('STConvLSTM2D').cell
+        self.states = {}
+        frame_spec = tf.TensorSpec((None, 9, None, None, 3), tf.float32)
+        state_spec = tf.TensorSpec((None, None, None, self.cell.filters), tf.float32)
+        self.step = tf.function(self._step, input_signature=[frame_spec, frame_spec, state_spec, state_spec])
+
+    def _step(self, h, v, r_h, c):
+        x = tf.concat([run_branch(h, self.branch_layers[0]), run_branch(v, self.branch_layers[1])], axis=-1)
+        for layer in self.conv_layers:
+            x = layer.layer(x)
+        r_d, (r_h, c) = self.cell.call(x, [r_h, c])
+        return r_d[..., 0], r_h, c
+
+    def reset(self, stream=None):
+        # forget the state of `stream` (every stream if None), e.g. at a scene cut
+        if stream is None:
+            self.states.clear()
+        else:
+            self.states.pop(stream, None)
+
+    def __call__(self, frame_h, frame_v, stream=0):
+        # frame_h, frame_v: (angle, height, width, channel) frames, or (batch, ...) for several tiles
+        # of the same stream, uint8 or float in [0, 1] -> disparity (height, width) or (batch, height, width)
+        single = frame_h.ndim == 4
+        h, v = as_float(*(frame[None] if single else frame for frame in (frame_h, frame_v)))
+        state_shape = (h.shape[0], h.shape[2], h.shape[3], self.cell.filters)
+        if stream not in self.states:
+            self.states[stream] = [tf.zeros(state_shape), tf.zeros(state_shape)]
+        r_h, c = self.states[stream]
+        if tuple(r_h.shape) != state_shape:
+            raise Exception(f'frames of stream {stream} must keep the shape {tuple(r_h.shape)}, but receive {state_shape}. '
+                            'Reset the stream to change it.')
+        disp, r_h, c = self.step(tf.constant(h, tf.float32), tf.constant(v, tf.float32), r_h, c)
+        self.states[stream] = [r_h, c]
+        disp = disp.numpy()
+        return disp[0] if single else disp
+
+
+class window_estimator():
+    # Sliding-window inference of either model with the 3D conv branches run once per (frame, tile):
+    # the branch features of the frames of the current window are cached by frame index, frames that
+    # left the window are evicted, and the head (2D convs / recurrence) runs on the cached features of
+    # each window. Windows of one set of tiles must come in key frame order; reset() before other tiles.
+    # Features are computed per frame, so the branch mean is over the frame's tiles instead of the window's.
+    def __init__(self, model, frame_length=5):
+        self.frame_length = frame_length
+        self.branch_layers = branch_layers(model)
+        self.head = head_model(model)
+        self.features = collections.OrderedDict()
+        frame_spec = tf.TensorSpec((None, 9, None, None, 3), tf.float32)
+        self.branches = tf.function(self._branches, input_signature=[frame_spec, frame_spec])
+
+    def _branches(self, h, v):
+        return tf.concat([run_branch(h, self.branch_layers[0]), run_branch(v, self.branch_layers[1])], axis=-1)
+
+    def reset(self):
+        self.features.clear()
+
+    def __call__(self, key_frame, read_frame):
+        # read_frame(frame) -> (h, v) tiles (batch, angle, height, width, channel) of a frame
+        # -> disparity of the window (batch, frame_length, height, width)
+        frames = range(key_frame, key_frame + self.frame_length)
+        for frame in list(self.features):
+            if frame not in frames:
+                del self.features[frame]
+        for frame in frames:
+            if frame not in self.features:
+                h, v = as_float(*read_frame(frame))
+                self.features[frame] = self.branches(tf.constant(h, tf.float32), tf.constant(v, tf.float32))
+        x = tf.stack([self.features[frame] for frame in frames], axis=1)
+        return self.head.predict_on_batch(x)
+
+
+def receptive_halo(model, frame_length=5):
+    # pixels around an output pixel it depends on: 1 per 3x3 conv of the branches (4) and the head,
+    # and with the STConvLSTM2D cell its input conv, RefineNet to r_d (5x5, 5x5, 5x5) and for every
+    # earlier frame of the window the recurrent conv and RefineNet to r_h (5x5, 5x5, 3x3)
+    halo = len(branch_layers(model)[0]) - 2   # Conv3D layers between the padding and the squeeze
+    for layer in model.layers:
+        if isinstance(layer, TimeDistributed) and isinstance(layer.layer, Conv2D):
+            halo += (layer.layer.kernel_size[0] - 1) // 2
+    if any(layer.name == 'STConvLSTM2D' for layer in model.layers):
+        cell = model.get_layer('STConvLSTM2D').cell
+        halo += (cell.kernel_size[0] - 1) // 2 + 6 + (frame_length - 1) * ((cell.kernel_size[0] - 1) // 2 + 5)
+    return halo
+
+
+# float32 bytes per input pixel and frame of a tile at the peak of inference: the input and output
+# of the largest Conv3D (7 angles x 32 -> 5 angles x 64 channels) and the concatenated h, v features
+BRANCH_BYTES_PER_PIXEL = 4 * (7*32 + 5*64 + 128)
+
+def tile_size(halo, frame_length=5, memory_bytes=2**30):
+    # side of the largest square tile whose haloed input fits memory_bytes of activations
+    side = int(np.sqrt(memory_bytes / (frame_length * BRANCH_BYTES_PER_PIXEL))) - 2*halo
+    if side < 16:
+        raise Exception(f'{memory_bytes} bytes do not fit a 16x16 tile with a halo of {halo} pixels.')
+    return side
+
+
+class tiled_estimator():
+    # Full-frame inference of either model: the frames of a window are split into square tiles with a
+    # halo of the receptive field radius (receptive_halo), the tiles run through the model one by one
+    # and the halos are cropped, so every output pixel is computed once and equals the full-frame
+    # output. Halos are clipped at the frame borders, where the layers pad as on the full frame.
+    # The branches subtract the mean of the whole window (passed explicitly), not the tile's.
+    def __init__(self, model, frame_length=5, memory_bytes=2**30):
+        self.frame_length = frame_length
+        self.halo = receptive_halo(model, frame_length)
+        self.tile_size = tile_size(self.halo, frame_length, memory_bytes)
+        self.branch_layers = branch_layers(model)
+        self.head = head_model(model)
+        frame_spec = tf.TensorSpec((None, 9, None, None, 3), tf.float32)
+        mean_spec = tf.TensorSpec((3,), tf.float32)
+        self.step = tf.function(self._step, input_signature=[frame_spec, frame_spec, mean_spec, mean_spec])
+
+    def _step(self, h, v, mean_h, mean_v):
+        # (frame, angle, height, width, channel) tiles of a window -> (frame, height, width)
+        x = tf.concat([run_branch(h, self.branch_layers[0], mean_h), run_branch(v, self.branch_layers[1], mean_v)], axis=-1)
+        return self.head(x[None])[0]
+
+    def __call__(self, seq_h, seq_v):
+        # seq_h, seq_v: (frame, angle, height, width, channel) window, uint8 or float in [0, 1] -> (frame, height, width)
+        frames, _, h_size, w_size, _ = seq_h.shape
+        scale = 255.0 if seq_h.dtype == np.uint8 else 1.0
+        mean_h = tf.constant(seq_h.mean(axis=(0, 1, 2, 3)) / scale, tf.float32)
+        mean_v = tf.constant(seq_v.mean(axis=(0, 1, 2, 3)) / scale, tf.float32)
+        out = np.empty((frames, h_size, w_size), dtype=np.float32)
+        size, halo = self.tile_size, self.halo
+        for y in range(0, h_size, size):
+            for x in range(0, w_size, size):
+                y0, y1 = max(y - halo, 0), min(y + size + halo, h_size)
+                x0, x1 = max(x - halo, 0), min(x + size + halo, w_size)
+                h, v = as_float(seq_h[:, :, y0:y1, x0:x1], seq_v[:, :, y0:y1, x0:x1])
+                pred = self.step(tf.constant(h, tf.float32), tf.constant(v, tf.float32), mean_h, mean_v).numpy()
+                tile = out[:, y:y+size, x:x+size]
+                tile[:] = pred[:, y-y0:y-y0+tile.shape[1], x-x0:x-x0+tile.shape[2]]
+        return out
+
+
+if __name__ == "__main__":
+    # streams the frames of a scene store (create_dataset.py --layout scene) through the model
+    # and saves the disparity of every frame next to the weights
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model_weights_path')
+    parser.add_argument('scene_dir', help=f'scene directory with a {SCENE_STORE_NAME}')
+    args=parser.parse_args()
+
+    estimator = stream_estimator(args.model_weights_path)
+    store = SceneStore(Path(args.scene_dir) / SCENE_STORE_NAME)
+    save_dir = Path(args.model_weights_path).parent / 'streamed'
+    save_dir.mkdir(parents=True, exist_ok=True)
+    scene_name = Path(args.scene_dir).name
+    for i in range(store.frame_n):
+        start = time.perf_counter()
+        pred = estimator(store.h[i], store.v[i], stream=scene_name)
+        print(f'{scene_name} frame {i}: {(time.perf_counter() - start)*1e3:.0f} ms')
+        np.savez_compressed(save_dir / f'{scene_name}_{i:03}.npz', pred=pred, gt=store.disp[i])
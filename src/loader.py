@@ -0,0 +1,133 @@
+import collections
+import multiprocessing as mp
+import numpy as np
+import os
+import queue
+import traceback
+
+
+def _slot_arrays(buffers, shapes, dtypes):
+    return [[np.frombuffer(buffer, dtype=dtype).reshape(shape) for buffer, shape, dtype in zip(slot, shapes, dtypes)]
+            for slot in buffers]
+
+
+def _worker(datagen, jobs, ready, buffers, shapes, dtypes, cpus):
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+    slots = _slot_arrays(buffers, shapes, dtypes)
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        seq, slot, batch_samples, seed = job
+        # augmentation is seeded per batch by the sampler
+        np.random.seed(seed)
+        try:
+            datagen.make_batch(batch_samples, out=slots[slot])
+        except Exception:
+            # re-raised by flow() in the consumer
+            ready.put((seq, slot, traceback.format_exc()))
+            continue
+        ready.put((seq, slot, None))
+
+
+class prefetch_loader():
+    # Worker processes assemble batches of `datagen` directly into a ring of shared-memory
+    # batch slots, and flow() yields the slots in order, so batches are never pickled.
+    #   workers   number of worker processes
+    #   prefetch  batches being assembled or waiting ahead of the consumer
+    #   hold      yielded batches that are not overwritten yet, because the consumer
+    #             (e.g. the tf.data prefetch inside fit) may still reference them
+    #   affinity  None, 'auto' (one core per worker) or a list of cpu sets, one per worker
+    # Batches come from datagen.sampler() (rank's share of each epoch from the global step start_step)
+    # or the given sampler, so the output does not depend on the number of workers and equals
+    # datagen.flow_from_directory. With an importance_sampler the batches also carry its sample weights.
+    # Batches of the next epoch are only requested once the consumer took every batch of the current
+    # one, since an importance_sampler waits for the scores of the epoch before drawing the next.
+    # An exception in a worker is raised by flow() with the worker's traceback, and flow() raises
+    # if a worker process dies (e.g. killed by the OOM killer) instead of waiting for its batch.
+    def __init__(self, datagen, batch_size=64, workers=4, prefetch=8, hold=4, affinity=None, seed=None,
+                 rank=0, world_size=1, start_step=0, sampler=None):
+        self.datagen = datagen
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.hold = hold
+        self.sampler = sampler or datagen.sampler(batch_size, seed, rank, world_size)
+        self.start_step = start_step
+        self.shapes = datagen.batch_shapes(batch_size)
+        self.dtypes = datagen.batch_dtypes()
+        # fork, so that workers inherit the generator (and its memmaps) without pickling it
+        ctx = mp.get_context('fork')
+        self.buffers = [[ctx.RawArray('b', int(np.prod(shape)) * np.dtype(dtype).itemsize)
+                         for shape, dtype in zip(self.shapes, self.dtypes)]
+                        for _ in range(prefetch + hold)]
+        self.slots = _slot_arrays(self.buffers, self.shapes, self.dtypes)
+        if affinity == 'auto':
+            cpus = sorted(os.sched_getaffinity(0))
+            affinity = [{cpus[i % len(cpus)]} for i in range(workers)]
+        self.jobs = ctx.Queue()
+        self.ready = ctx.Queue()
+        self.workers = [ctx.Process(target=_worker, daemon=True,
+                                    args=(datagen, self.jobs, self.ready, self.buffers, self.shapes, self.dtypes,
+                                          None if affinity is None else affinity[i]))
+                        for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def batches(self):
+        for batch_indices, batch_seed in self.sampler.batches(self.start_step):
+            # weights are taken when the batch is drawn, with the probabilities it was drawn from
+            weights = self.sampler.weights(batch_indices) if hasattr(self.sampler, 'weights') else None
+            yield self.datagen.samples[batch_indices], batch_seed, weights
+
+    def flow(self):
+        batches = self.batches()
+        free = collections.deque(range(len(self.slots)))
+        held = collections.deque()
+        done = {}
+        weights = {}
+        submitted = 0
+        yielded = 0
+        epoch_steps = len(self.sampler)
+        while True:
+            while (free and submitted - yielded < self.prefetch
+                   and (self.start_step + submitted) // epoch_steps <= (self.start_step + yielded) // epoch_steps):
+                batch_samples, seed, weights[submitted] = next(batches)
+                self.jobs.put((submitted, free.popleft(), batch_samples, seed))
+                submitted += 1
+            # batches may finish out of order
+            while yielded not in done:
+                seq, slot, error = self.get_ready()
+                if error is not None:
+                    raise Exception(f'loader worker failed on batch {seq}:\n{error}')
+                done[seq] = slot
+            slot = done.pop(yielded)
+            batch_weights = weights.pop(yielded)
+            yielded += 1
+            seq_batch_h, seq_batch_v, seq_batch_disp = self.slots[slot]
+            if batch_weights is None:
+                yield [seq_batch_h, seq_batch_v], seq_batch_disp
+            else:
+                yield [seq_batch_h, seq_batch_v], seq_batch_disp, batch_weights
+            held.append(slot)
+            if len(held) > self.hold:
+                free.append(held.popleft())
+
+    def get_ready(self, poll=5.0):
+        # next finished batch, checking every `poll` seconds that the workers are alive
+        while True:
+            try:
+                return self.ready.get(timeout=poll)
+            except queue.Empty:
+                for worker in self.workers:
+                    if not worker.is_alive():
+                        raise Exception(f'loader worker {worker.pid} died with exit code {worker.exitcode}.')
+
+    def close(self):
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
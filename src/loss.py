@@ -9,11 +9,16 @@ def cos_similarity(a, b, axis=-1):
     cos = tf.reduce_sum(tf.multiply(norm_a,norm_b), axis=axis)
     return cos
 
+def sample_mean(x):
+    # mean over every axis but the batch axis
+    return K.mean(x, axis=list(range(1, K.ndim(x))))
+
 def get_loss_function():
-    get_gradient = sobel.Sobel().get_gradient
+    # per-sample loss (batch,), Keras averages it over the batch (weighted by sample_weight if given)
+    get_gradient = sobel.get_gradient
     def loss_function(disp, pred):
         # disp loss
-        loss_disp = K.mean(K.abs(pred - disp))
+        loss_disp = sample_mean(K.abs(pred - disp))
 
         # grad loss
         pred_grad = get_gradient(pred)
@@ -22,14 +27,14 @@ def get_loss_function():
         pred_grad_dy = K.expand_dims(pred_grad[..., 1], axis=-1)
         disp_grad_dx = K.expand_dims(disp_grad[..., 0], axis=-1)
         disp_grad_dy = K.expand_dims(disp_grad[..., 1], axis=-1)
-        loss_dx = K.mean(K.abs(pred_grad_dx - disp_grad_dx))
-        loss_dy = K.mean(K.abs(pred_grad_dy - disp_grad_dy))
+        loss_dx = sample_mean(K.abs(pred_grad_dx - disp_grad_dx))
+        loss_dy = sample_mean(K.abs(pred_grad_dy - disp_grad_dy))
 
         # normal loss
         ones = K.ones_like(disp_grad_dx)
         pred_normal = K.concatenate([-pred_grad_dx, -pred_grad_dy, ones], axis=-1)
         disp_normal = K.concatenate([-disp_grad_dx, -disp_grad_dy, ones], axis=-1)
-        loss_normal = K.mean(K.abs(1 - cos_similarity(pred_normal, disp_normal, axis=-1)))
+        loss_normal = sample_mean(K.abs(1 - cos_similarity(pred_normal, disp_normal, axis=-1)))
 
         return loss_disp + (loss_dx + loss_dy) + loss_normal
     return loss_function
\ No newline at end of file
@@ -2,6 +2,7 @@ from tensorflow.keras.layers import Input, Conv2D, Conv3D, ZeroPadding3D, Lambda
 from tensorflow.keras.models import Model
 from keras.engine.network import Network
 from tensorflow.keras import backend as K
+from .modules.recompute import Recompute
 
 import tensorflow as tf
 def allocate_gpu_memory(gpu_number=0):
@@ -27,7 +28,11 @@ def conv3D_branch(x):
     x = Lambda(lambda x: K.squeeze(x, axis=1))(x)
     return x
 
-def build_model():
+def scale_inputs(x, name):
+    # uint8 batches are cast and scaled to [0, 1] on the device
+    return Lambda(lambda x: K.cast(x, 'float32') / 255.0, name=name)(x)
+
+def build_model(uint8_inputs=False, recompute=False):
     frames = None
     s_size = None
     # prepare shared layers
@@ -36,10 +41,16 @@ def build_model():
     shared_layer_v = Network(dummy_frame_inputs, conv3D_branch(dummy_frame_inputs))
     
     # build model
-    inputs_h = Input(shape=((frames, 9, s_size, s_size, 3)), name='inputs_h')
-    processed_h = TimeDistributed(shared_layer_h, name='shared_3Dconv_branch_h')(inputs_h)
-    inputs_v = Input(shape=((frames, 9, s_size, s_size, 3)), name='inputs_v')
-    processed_v = TimeDistributed(shared_layer_v, name='shared_3Dconv_branch_v')(inputs_v)
+    # uint8_inputs: inputs_h, inputs_v take the uint8 images, scaled in the graph (the weights are the same)
+    input_dtype = 'uint8' if uint8_inputs else 'float32'
+    inputs_h = Input(shape=((frames, 9, s_size, s_size, 3)), dtype=input_dtype, name='inputs_h')
+    x_h = scale_inputs(inputs_h, 'scale_h') if uint8_inputs else inputs_h
+    # recompute: the activations of the 3D conv branches are recomputed in the backward pass instead of kept
+    wrap = Recompute if recompute else (lambda layer: layer)
+    processed_h = wrap(TimeDistributed(shared_layer_h, name='shared_3Dconv_branch_h'))(x_h)
+    inputs_v = Input(shape=((frames, 9, s_size, s_size, 3)), dtype=input_dtype, name='inputs_v')
+    x_v = scale_inputs(inputs_v, 'scale_v') if uint8_inputs else inputs_v
+    processed_v = wrap(TimeDistributed(shared_layer_v, name='shared_3Dconv_branch_v'))(x_v)
     x = Concatenate()([processed_h, processed_v])
     
     for n_filters in [64, 32, 32, 16]:
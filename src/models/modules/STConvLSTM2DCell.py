@@ -215,6 +215,51 @@ class STConvLSTM2DCell(DropoutRNNCellMixin, Layer):
     h_tm1 = states[0]  # previous memory state
     c_tm1 = states[1]  # previous carry state
 
+    # without dropout every gate sees the same inputs, so all gates come from one input conv
+    # and one recurrent conv with the whole kernels
+    if self.dropout == 0 and self.recurrent_dropout == 0:
+      x_i, x_f, x_c, x_o = self.fused_gates(inputs, h_tm1)
+    else:
+      x_i, x_f, x_c, x_o = self.split_gates(inputs, h_tm1, training)
+    return self.gate_outputs(x_i, x_f, x_c, x_o, c_tm1)
+
+  def gate_outputs(self, x_i, x_f, x_c, x_o, c_tm1):
+    i = self.recurrent_activation(x_i)
+    f = self.recurrent_activation(x_f)
+    c = f * c_tm1 + i * self.activation(x_c)
+    o = self.recurrent_activation(x_o)
+    h = K.concatenate((o, self.activation(c)), -1)
+    r_h, r_d = self.refine_net(h)
+    return r_d, [r_h, c]
+
+  def fused_gates(self, inputs, h_tm1):
+    # gate pre-activations (i, f, c, o), split after the convolutions
+    z = self.input_conv(inputs, self.kernel, self.bias, padding=self.padding)
+    z += self.recurrent_conv(h_tm1, self.recurrent_kernel)
+    return self.split_channels(z)
+
+  def split_channels(self, z):
+    channel_axis = 1 if self.data_format == 'channels_first' else -1
+    return array_ops.split(z, [self.filters, self.filters, self.filters, self.input_dim], axis=channel_axis)
+
+  def input_gates(self, inputs):
+    # input half of the gate pre-activations of all timesteps (without dropout), as one conv
+    # over (samples*timesteps, rows, cols, channels): (samples, timesteps, ...) -> (samples, timesteps, ..., gates)
+    shape = array_ops.shape(inputs)
+    x = array_ops.reshape(inputs, array_ops.concat([[-1], shape[2:]], axis=0))
+    z = self.input_conv(x, self.kernel, self.bias, padding=self.padding)
+    return array_ops.reshape(z, array_ops.concat([shape[:2], array_ops.shape(z)[1:]], axis=0))
+
+  def recurrent_call(self, z_x, states):
+    # call() for a timestep of input_gates(), leaving the recurrent conv and RefineNet
+    h_tm1 = states[0]  # previous memory state
+    c_tm1 = states[1]  # previous carry state
+    z = z_x + self.recurrent_conv(h_tm1, self.recurrent_kernel)
+    x_i, x_f, x_c, x_o = self.split_channels(z)
+    return self.gate_outputs(x_i, x_f, x_c, x_o, c_tm1)
+
+  def split_gates(self, inputs, h_tm1, training=None):
+    # gate pre-activations (i, f, c, o) with a dropout mask per gate
     # dropout matrices for input units
     dp_mask = self.get_dropout_mask_for_cell(inputs, training, count=4)
     # dropout matrices for recurrent units
@@ -263,14 +308,7 @@ class STConvLSTM2DCell(DropoutRNNCellMixin, Layer):
     h_f = self.recurrent_conv(h_tm1_f, recurrent_kernel_f)
     h_c = self.recurrent_conv(h_tm1_c, recurrent_kernel_c)
     h_o = self.recurrent_conv(h_tm1_o, recurrent_kernel_o)
-
-    i = self.recurrent_activation(x_i + h_i)
-    f = self.recurrent_activation(x_f + h_f)
-    c = f * c_tm1 + i * self.activation(x_c + h_c)
-    o = self.recurrent_activation(x_o + h_o)
-    h = K.concatenate((o, self.activation(c)), -1)
-    r_h, r_d = self.refine_net(h)
-    return r_d, [r_h, c]
+    return x_i + h_i, x_f + h_f, x_c + h_c, x_o + h_o
 
   def input_conv(self, x, w, b=None, padding='valid'):
     conv_out = K.conv2d(x, w, strides=self.strides,
@@ -161,10 +161,14 @@ class ConvRNN2D(RNN):
                go_backwards=False,
                stateful=False,
                unroll=False,
+               hoist_input_conv=False,
                **kwargs):
     if unroll:
       raise TypeError('Unrolling isn\'t possible with '
                       'convolutional RNNs.')
+    # hoist_input_conv: compute the input half of the gates of all timesteps before the recurrence
+    # (cells with input_gates() and recurrent_call(), without dropout) and unroll known timesteps
+    self.hoist_input_conv = hoist_input_conv
     if isinstance(cell, (list, tuple)):
       # The StackedConvRNN2DCells isn't implemented yet.
       raise TypeError('It is not possible at the moment to'
@@ -180,6 +184,11 @@ class ConvRNN2D(RNN):
     self.states = None
     self._num_constants = None
 
+  def get_config(self):
+    config = {'hoist_input_conv': self.hoist_input_conv}
+    base_config = super(ConvRNN2D, self).get_config()
+    return dict(list(base_config.items()) + list(config.items()))
+
   @tf_utils.shape_type_conversion
   def compute_output_shape(self, input_shape):
     if isinstance(input_shape, list):
@@ -322,12 +331,25 @@ class ConvRNN2D(RNN):
       def step(inputs, states):
         return self.cell.call(inputs, states, **kwargs)
 
+    unroll = False
+    if (self.hoist_input_conv and not constants and hasattr(self.cell, 'input_gates')
+        and self.cell.dropout == 0 and self.cell.recurrent_dropout == 0):
+      # the input convs do not depend on the states, so they run as one batched conv
+      # and the step is left with the recurrent conv
+      inputs = self.cell.input_gates(inputs)
+
+      def step(inputs, states):
+        return self.cell.recurrent_call(inputs, states)
+      # short sequences of a known length are unrolled statically
+      unroll = timesteps is not None
+
     last_output, outputs, states = K.rnn(step,
                                          inputs,
                                          initial_state,
                                          constants=constants,
                                          go_backwards=self.go_backwards,
                                          mask=mask,
+                                         unroll=unroll,
                                          input_length=timesteps)
     if self.stateful:
       updates = [
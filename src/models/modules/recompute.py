@@ -0,0 +1,22 @@
+import tensorflow as tf
+from tensorflow.keras.layers import Wrapper
+
+
+class Recompute(Wrapper):
+    # Runs the wrapped layer under tf.recompute_grad: its intermediate activations are not kept for
+    # the backward pass but recomputed from the layer input, trading step time for peak memory.
+    # The weights are the wrapped layer's, in the same order, so weight files stay compatible.
+    def __init__(self, layer, **kwargs):
+        kwargs.setdefault('name', f'{layer.name}_recompute')
+        super().__init__(layer, **kwargs)
+
+    def build(self, input_shape):
+        if not self.layer.built:
+            self.layer.build(input_shape)
+        super().build(input_shape)
+
+    def call(self, inputs, training=None):
+        return tf.recompute_grad(lambda x: self.layer(x, training=training))(inputs)
+
+    def compute_output_shape(self, input_shape):
+        return self.layer.compute_output_shape(input_shape)
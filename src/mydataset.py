@@ -0,0 +1,214 @@
+import numpy as np
+import os
+import tensorflow as tf
+
+# my modules
+from mygenerator import load_scene_stores
+from patch_store import PatchStore
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+
+def _rot90(x, axis):
+    # np.rot90(x, 1, (axis, axis+1))
+    perm = list(range(len(x.shape)))
+    perm[axis], perm[axis+1] = perm[axis+1], perm[axis]
+    return tf.reverse(tf.transpose(x, perm), [axis])
+
+
+class input_dataset():
+    # tf.data counterpart of input_generator_fl5 / test_generator, reading the same scene stores.
+    # Training draws a uniform random permutation of all samples every epoch, like the generator's
+    # epoch_sampler (but from the TF random ops, so not the same order for the same seed), and reads
+    # each sample by index in parallel: from raw patch stores natively in the graph, from compressed
+    # patch stores and scene stores through the store readers in tf.numpy_function (holding the GIL).
+    # Only the batch that spans two epochs mixes two epochs.
+    # Validation and test read the scenes in parallel with interleave: raw patch stores natively as
+    # fixed-length records, compressed patch stores and scene stores through the store readers.
+    def __init__(self, class_list_path, frame_length=5):
+        self.scene_names, self.stores, self.samples = load_scene_stores(class_list_path, frame_length)
+        self.frame_length = frame_length
+        self.store_frame_length = self.stores[0].frame_length
+        self.patch_size = self.stores[0].patch_size
+        if not 0 < frame_length <= self.store_frame_length:
+            raise Exception(f'frame_length must be an integer between 1 and {self.store_frame_length} for these patch stores, '
+                            f'but receive {frame_length}. Longer windows need a dataset built with --layout scene.')
+        self.native = all(isinstance(store, PatchStore) and store.codec == 'raw' for store in self.stores)
+
+    def sample_shapes(self):
+        frames, size = self.frame_length, self.patch_size
+        return (frames, 9, size, size, 3), (frames, 9, size, size, 3), (frames, size, size)
+
+    def record_decoder(self):
+        # (scene, raw patch store record, first frame of the window) -> (scene, h, v, disp),
+        # decoding only the frame_length frames of the window
+        h_shape, v_shape, disp_shape = self.sample_shapes()
+        size, frame_length = self.patch_size, self.frame_length
+        h_frame_bytes, disp_frame_bytes = 9 * size * size * 3, 4 * size * size
+        h_bytes = self.store_frame_length * h_frame_bytes
+
+        def decode(scene, record, start=0):
+            h = tf.strings.substr(record, start*h_frame_bytes, frame_length*h_frame_bytes)
+            v = tf.strings.substr(record, h_bytes + start*h_frame_bytes, frame_length*h_frame_bytes)
+            disp = tf.strings.substr(record, 2*h_bytes + start*disp_frame_bytes, frame_length*disp_frame_bytes)
+            h = tf.reshape(tf.io.decode_raw(h, tf.uint8), h_shape)
+            v = tf.reshape(tf.io.decode_raw(v, tf.uint8), v_shape)
+            disp = tf.reshape(tf.io.decode_raw(disp, tf.float32), disp_shape)
+            return scene, h, v, disp
+        return decode
+
+    def read_records(self):
+        # scene -> dataset of (scene, h, v, disp) samples read with FixedLengthRecordDataset,
+        # decoding only the first frame_length frames
+        record_bytes = self.stores[0].arrays['patches'].dtype.itemsize
+        paths, header_bytes, footer_bytes = [], [], []
+        for store in self.stores:
+            offset = store.header['arrays']['patches']['offset']
+            paths.append(str(store.path))
+            header_bytes.append(offset)
+            footer_bytes.append(os.path.getsize(store.path) - offset - store.arrays['patches'].nbytes)
+        paths, header_bytes, footer_bytes = tf.constant(paths), tf.constant(header_bytes, tf.int64), tf.constant(footer_bytes, tf.int64)
+        decode = self.record_decoder()
+
+        def read(scene):
+            records = tf.data.FixedLengthRecordDataset(paths[scene], record_bytes,
+                                                       header_bytes=header_bytes[scene], footer_bytes=footer_bytes[scene])
+            return records.map(lambda record: decode(tf.cast(scene, tf.int32), record))
+        return read
+
+    def read_record_index(self, random_window):
+        # sample index -> dataset of its (scene, h, v, disp) read natively from a raw patch store: a
+        # FixedLengthRecordDataset whose header and footer leave exactly the sample's record at its byte offset
+        record_bytes = self.stores[0].arrays['patches'].dtype.itemsize
+        offsets = np.empty(len(self.samples), dtype=np.int64)
+        file_bytes = np.empty(len(self.samples), dtype=np.int64)
+        for scene, store in enumerate(self.stores):
+            rows = self.samples[:, 0] == scene
+            record = np.ravel_multi_index(tuple(self.samples[rows, 1:].T), store.shape)
+            offsets[rows] = store.header['arrays']['patches']['offset'] + record.astype(np.int64) * record_bytes
+            file_bytes[rows] = os.path.getsize(store.path)
+        paths = tf.constant([str(store.path) for store in self.stores])
+        scenes = tf.constant(self.samples[:, 0], tf.int32)
+        offsets, file_bytes = tf.constant(offsets), tf.constant(file_bytes)
+        window_n = self.store_frame_length - self.frame_length + 1
+        decode = self.record_decoder()
+
+        def read(index):
+            scene, offset = scenes[index], offsets[index]
+            records = tf.data.FixedLengthRecordDataset(paths[scene], record_bytes, header_bytes=offset,
+                                                       footer_bytes=file_bytes[index] - offset - record_bytes,
+                                                       buffer_size=record_bytes)
+            start = tf.random.uniform((), 0, window_n, dtype=tf.int32) if random_window else 0
+            return records.map(lambda record: decode(scene, record, start))
+        return read
+
+    def read_index(self, random_window):
+        # sample index -> (scene, h, v, disp) read by its store in Python (compressed patch stores and
+        # scene stores), decoding only the frames of the temporal window
+        h_shape, v_shape, disp_shape = self.sample_shapes()
+        window_n = self.store_frame_length - self.frame_length + 1
+
+        def read_sample(index, start):
+            scene, key_frame, iy, ix = self.samples[index]
+            h, v, disp = np.empty(h_shape, np.uint8), np.empty(v_shape, np.uint8), np.empty(disp_shape, np.float32)
+            self.stores[scene].read((key_frame, iy, ix), h, v, disp, start)
+            return scene, h, v, disp
+
+        def read(index):
+            start = tf.random.uniform((), 0, window_n, dtype=tf.int32) if random_window else 0
+            scene, h, v, disp = tf.numpy_function(read_sample, [index, start], (tf.int32, tf.uint8, tf.uint8, tf.float32))
+            scene.set_shape(())
+            h.set_shape(h_shape)
+            v.set_shape(v_shape)
+            disp.set_shape(disp_shape)
+            return scene, h, v, disp
+        return read
+
+    def read_samples(self):
+        # scene -> dataset of (scene, h, v, disp) samples read by the store (decoding the first
+        # frame_length frames of compressed records or cutting windows out of a scene store)
+        h_shape, v_shape, disp_shape = self.sample_shapes()
+        scene_samples = [self.samples[self.samples[:, 0] == scene] for scene in range(len(self.stores))]
+
+        def samples(scene):
+            store = self.stores[scene]
+            for _, key_frame, iy, ix in scene_samples[scene]:
+                h, v, disp = np.empty(h_shape, np.uint8), np.empty(v_shape, np.uint8), np.empty(disp_shape, np.float32)
+                store.read((key_frame, iy, ix), h, v, disp)
+                yield scene, h, v, disp
+
+        def read(scene):
+            return tf.data.Dataset.from_generator(samples, (tf.int32, tf.uint8, tf.uint8, tf.float32),
+                                                  ((), h_shape, v_shape, disp_shape), args=(scene,))
+        return read
+
+    def augmentation(self, h, v, disp, gammma, horizontal_flip, vertical_flip, rotation, uint8=False):
+        # uint8 h, v: (frame, angle, height, width, channel), disp: (frame, height, width)
+        # returns h, v in [0, 1], or uint8 again with `uint8`
+        if horizontal_flip:
+            flip = tf.random.uniform(()) < 0.5
+            h, v, disp = tf.cond(flip, lambda: (h[:, ::-1, :, ::-1], v[:, :, :, ::-1], disp[:, :, ::-1]), lambda: (h, v, disp))
+        if vertical_flip:
+            flip = tf.random.uniform(()) < 0.5
+            h, v, disp = tf.cond(flip, lambda: (h[:, :, ::-1], v[:, ::-1, ::-1], disp[:, ::-1]), lambda: (h, v, disp))
+        if rotation:
+            rot90_n = tf.random.uniform((), 0, 4, dtype=tf.int32)
+            for rot_step in range(1, 4):
+                h, v, disp = tf.cond(rot90_n >= rot_step,
+                                     lambda: (_rot90(v, 2)[:, ::-1], _rot90(h, 2), _rot90(disp, 1)),
+                                     lambda: (h, v, disp))
+        if not gammma:
+            return (h, v, disp) if uint8 else (tf.cast(h, tf.float32) / 255.0, tf.cast(v, tf.float32) / 255.0, disp)
+        h = tf.cast(h, tf.float32) / 255.0
+        v = tf.cast(v, tf.float32) / 255.0
+        gamma = tf.random.uniform((), 0.8, 1.2)
+        h, v = tf.pow(h, gamma), tf.pow(v, gamma)
+        if uint8:
+            h, v = tf.cast(tf.round(h * 255.0), tf.uint8), tf.cast(tf.round(v * 255.0), tf.uint8)
+        return h, v, disp
+
+    def build(self, batch_size=64, mode='train', gammma=False, horizontal_flip=False, vertical_flip=False, rotation=False,
+              cycle_length=8, cache=True, seed=None, uint8=False):
+        # mode 'train': shuffled, augmented and repeated, yields ((h, v), disp)
+        #      'valid': repeated, cached in memory after the first epoch if `cache`, yields ((h, v), disp)
+        #      'test':  one pass in sample order including the remainder, yields ((h, v), disp, scene)
+        # h, v are float32 in [0, 1], or uint8 with `uint8` for models built with uint8_inputs
+        if mode not in ['train', 'valid', 'test']:
+            raise Exception(f"mode must be 'train', 'valid' or 'test', but receive {mode}.")
+        train = mode == 'train'
+        scenes = tf.data.Dataset.range(len(self.stores))
+        if train:
+            # a full-size shuffle of the indices is an exact permutation, redrawn every epoch;
+            # the frame window is random in training and the first frames otherwise
+            indices = tf.data.Dataset.range(len(self.samples))
+            indices = indices.shuffle(len(self.samples), seed=seed, reshuffle_each_iteration=True).repeat()
+            if self.native:
+                dataset = indices.interleave(self.read_record_index(random_window=True), cycle_length=cycle_length,
+                                             num_parallel_calls=AUTOTUNE, deterministic=False)
+            else:
+                dataset = indices.map(self.read_index(random_window=True), num_parallel_calls=AUTOTUNE, deterministic=False)
+        elif mode == 'test':
+            # the test order must follow the samples for evaluate's full-frame maps
+            dataset = scenes.interleave(self.read_records() if self.native else self.read_samples(), cycle_length=1)
+        else:
+            dataset = scenes.interleave(self.read_records() if self.native else self.read_samples(),
+                                        cycle_length=min(cycle_length, len(self.stores)),
+                                        num_parallel_calls=AUTOTUNE, deterministic=False)
+        if mode == 'valid':
+            # the uint8 windows of the validation set, so the cache needs about a quarter of the float32 size
+            if cache:
+                dataset = dataset.cache()
+            dataset = dataset.repeat()
+
+        def convert(scene, h, v, disp):
+            if train:
+                h, v, disp = self.augmentation(h, v, disp, gammma, horizontal_flip, vertical_flip, rotation, uint8)
+            elif not uint8:
+                h, v = tf.cast(h, tf.float32) / 255.0, tf.cast(v, tf.float32) / 255.0
+            if mode == 'test':
+                return (h, v), disp, scene
+            return (h, v), disp
+
+        dataset = dataset.map(convert, num_parallel_calls=AUTOTUNE, deterministic=(mode == 'test'))
+        dataset = dataset.batch(batch_size, drop_remainder=(mode != 'test'))
+        return dataset.prefetch(AUTOTUNE)
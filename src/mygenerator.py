@@ -1,128 +1,319 @@
 import csv
 import numpy as np
 import pathlib
-import re
+
+# my modules
+from patch_store import MANIFEST_NAME, SceneStore, load_manifest, open_store, patch_grid
+from sample_cache import sample_cache
+from sampler import epoch_sampler
+
+
+class window_sampler():
+    # cuts (frame_length, patch_size) windows out of a full-frame scene store as strided views,
+    # so every frame is stored once instead of once per overlapping patch and window
+    def __init__(self, store, frame_length=5, patch_size=32, stride=16):
+        self.store = store
+        self.frame_length = frame_length
+        self.patch_size = patch_size
+        self.stride = stride
+        _, _, h_size, w_size, _ = store.h.shape
+        self.shape = patch_grid(store.frame_n, h_size, w_size, frame_length, patch_size, stride)
+
+    def __len__(self):
+        return int(np.prod(self.shape))
+
+    def __getitem__(self, key):
+        # key: (key_frame, iy, ix), same addressing as PatchStore
+        key_frame, iy, ix = key
+        t = slice(key_frame, key_frame+self.frame_length)
+        y = slice(iy*self.stride, iy*self.stride+self.patch_size)
+        x = slice(ix*self.stride, ix*self.stride+self.patch_size)
+        return self.store.h[t, :, y, x], self.store.v[t, :, y, x], self.store.disp[t, y, x]
+
+    def read(self, key, out_h, out_v, out_disp, start=0):
+        # frames start .. start+len(out_disp)-1 of window `key`
+        frames = slice(start, start+len(out_disp))
+        for out, window in zip([out_h, out_v, out_disp], self[key]):
+            np.copyto(out, window[frames])
+
+
+def load_samples(data_root, scene_names, stores, frame_length, patch_size, stride):
+    # samples: (scene, key_frame, iy, ix) rows, from the manifest when it matches
+    if (data_root / MANIFEST_NAME).exists():
+        manifest = load_manifest(data_root)
+        if ((manifest['frame_length'], manifest['patch_size'], manifest['stride']) == (frame_length, patch_size, stride)
+                and set(scene_names) <= set(manifest['scenes'])):
+            manifest_samples = manifest['samples']
+            samples = []
+            for i, scene_name in enumerate(scene_names):
+                # manifest rows are sorted by scene
+                scene_id = manifest['scenes'].index(scene_name)
+                start, stop = np.searchsorted(manifest_samples['scene'], [scene_id, scene_id+1])
+                rows = manifest_samples[start:stop]
+                samples.append(np.stack([np.full(len(rows), i), rows['key_frame'], rows['iy'], rows['ix']], axis=1))
+            return np.concatenate(samples).astype(np.int32)
+        print(f'{data_root / MANIFEST_NAME} does not match, reading the sample list from the stores')
+    return np.concatenate([np.concatenate([np.full((len(store), 1), i), np.indices(store.shape).reshape(3, -1).T], axis=1)
+                            for i, store in enumerate(stores)]).astype(np.int32)
+
+
+def load_scene_stores(class_list_path, frame_length=5, patch_size=32, stride=16):
+    with open(class_list_path) as f:
+        reader = csv.reader(f)
+        scene_names = [str(scene_name) for row in reader for scene_name in row]
+    data_root = pathlib.Path(class_list_path).parent
+    stores = [open_store(data_root / scene_name) for scene_name in scene_names]
+    stores = [window_sampler(store, frame_length, patch_size, stride) if isinstance(store, SceneStore) else store
+                for store in stores]
+    # patch stores hold their own window length, scene stores are cut into frame_length windows
+    samples = load_samples(data_root, scene_names, stores, stores[0].frame_length, patch_size, stride)
+    return scene_names, stores, samples
+
+
+# (x / 255) ** gamma for 257 gammas in [0.8, 1.2] (GAMMA_LUT[128] is gamma 1) and every uint8 x
+GAMMA_LUT = (np.arange(256) / 255.0)[None, :] ** np.linspace(0.8, 1.2, 257)[:, None]
+GAMMA_LUT = GAMMA_LUT.astype(np.float32)
+GAMMA_LUT_UINT8 = np.round(GAMMA_LUT * 255).astype(np.uint8)   # for uint8 outputs
+
+OUT_RING = 4  # output batches in flight before a buffer is reused (tf.data prefetch in fit may still hold them)
+
+
+class batch_buffers():
+    # arrays reused by every batch: uint8 read buffers the samples are decoded into and a ring of
+    # output buffers (float32, or uint8 h, v), so steady-state batch assembly allocates no batch-sized arrays
+    def __init__(self, read_shapes, out_shapes, ring=OUT_RING, out_dtypes=(np.float32, np.float32, np.float32)):
+        h, v, disp = read_shapes
+        self.read = [np.empty(h, dtype=np.uint8), np.empty(v, dtype=np.uint8), np.empty(disp, dtype=np.float32)]
+        self.outs = [[np.empty(shape, dtype=dtype) for shape, dtype in zip(out_shapes, out_dtypes)] for _ in range(ring)]
+        self.index = None   # flat gamma lookup indices of an h or v batch, allocated on the first gamma batch
+        self.out_n = 0
+
+    def next_out(self):
+        out = self.outs[self.out_n % len(self.outs)]
+        self.out_n += 1
+        return out
+
+
+def read_samples(stores, batch_samples, out_h, out_v, out_disp, start=0, cache=None):
+    # reads frames start .. start+frame_length-1 of every sample, through the sample cache if given
+    for i, (scene, key_frame, iy, ix) in enumerate(batch_samples):
+        if cache is None:
+            stores[scene].read((key_frame, iy, ix), out_h[i], out_v[i], out_disp[i], start)
+        else:
+            cache.read(scene, (key_frame, iy, ix), out_h[i], out_v[i], out_disp[i], start)
 
 
 class input_generator_fl5():
+    frame_length = 5  # frames per output sample
+
     def __init__(self, class_list_path, val_mode=False,
-                gammma=False, horizontal_flip=False, vertical_flip=False, rotation=False):
-        self.clear()
+                gammma=False, horizontal_flip=False, vertical_flip=False, rotation=False, frame_length=None,
+                cache_bytes=0, shared_cache=False, patch_size=32, stride=16, uint8_output=False):
+        # uint8_output: h, v batches stay uint8 for models built with uint8_inputs, which scale them in the graph
         self.val_mode = val_mode
-        with open(class_list_path) as f:
-            reader = csv.reader(f)
-            scene_names = np.array([row for row in reader]).flatten()
-        scene_dirs = [pathlib.Path(class_list_path).parent / scene_name
-                        for scene_name in scene_names]
-        self.data_paths = [npz_path for scene_dir in scene_dirs
-                                    for npz_path in scene_dir.glob('*[!full].npz')]
+        self.uint8_output = uint8_output
+        if frame_length is not None:
+            self.frame_length = frame_length
+        self.scene_names, self.stores, self.samples = load_scene_stores(class_list_path, self.frame_length, patch_size, stride)
+        self.patch_size = self.stores[0].patch_size
+        if (self.patch_size, self.stores[0].stride) != (patch_size, stride):
+            raise Exception(f'the patch stores hold {self.patch_size}x{self.patch_size} patches with stride {self.stores[0].stride}, '
+                            f'but receive patch_size={patch_size}, stride={stride}. Other sizes need a dataset built with --layout scene.')
+        self.store_frame_length = self.stores[0].frame_length
+        if not 0 < self.frame_length <= self.store_frame_length:
+            raise Exception(f'frame_length must be an integer between 1 and {self.store_frame_length} for these patch stores, '
+                            f'but receive {self.frame_length}. Longer windows need a dataset built with --layout scene.')
         self.gammma = gammma
         self.horizontal_flip = horizontal_flip
         self.vertical_flip = vertical_flip
         self.rotation = rotation
-    
-    def clear(self):
-        self.seq_h = []
-        self.seq_v = []
-        self.seq_disp = []
-    
-    def convert(self, seq_batch_h, seq_batch_v, seq_batch_disp):
-        # any process
-        return seq_batch_h, seq_batch_v, seq_batch_disp
-
-    def augmentation(self, seq_batch_h, seq_batch_v, seq_batch_disp):
-        for i in range(len(seq_batch_disp)):
-            if self.gammma:
-                gamma_rand = 0.4 * np.random.rand() + 0.8
-                seq_batch_h[i] = pow(seq_batch_h[i], gamma_rand)
-                seq_batch_v[i] = pow(seq_batch_v[i], gamma_rand)
-            if self.horizontal_flip:
-                flip_rand = np.random.randint(0,2)
-                if flip_rand == 1:
-                    seq_batch_h[i] = seq_batch_h[i][:, ::-1, :, ::-1, :]  # (frame, angle, height, width, channel)
-                    seq_batch_v[i] = seq_batch_v[i][:,    :, :, ::-1, :]
-                    seq_batch_disp[i] = seq_batch_disp[i][:, :, ::-1]     # (frame, height, width)
-            if self.vertical_flip:
-                flip_rand = np.random.randint(0,2)
-                if flip_rand == 1:
-                    seq_batch_h[i] = seq_batch_h[i][:,    :, ::-1, :, :]  # (frame, angle, height, width, channel)
-                    seq_batch_v[i] = seq_batch_v[i][:, ::-1, ::-1, :, :]
-                    seq_batch_disp[i] = seq_batch_disp[i][:, ::-1, :]     # (frame, height, width)
-            if self.rotation:
-                rot90_rand = np.random.randint(0,4)
-                for rot_step in range(rot90_rand):
-                    seq_batch_h_rot90 = np.copy(np.rot90(seq_batch_h[i], 1, (2, 3)))
-                    seq_batch_v_rot90 = np.copy(np.rot90(seq_batch_v[i], 1, (2, 3)))
-                    seq_batch_h[i] = seq_batch_v_rot90[:, ::-1]
-                    seq_batch_v[i] = seq_batch_h_rot90
-                    seq_batch_disp[i] = np.copy(np.rot90(seq_batch_disp[i], 1, (1, 2))) 
-        return seq_batch_h, seq_batch_v, seq_batch_disp
-    
-    def flow_from_directory(self, batch_size=64, seed=None):
-        np.random.seed(seed)
+        self.buffers = None
+        self.set_cache(cache_bytes, shared_cache)
+
+    def set_cache(self, cache_bytes, shared_cache=False):
+        # decoded uint8 samples, shared with prefetch_loader workers if shared_cache
+        self.cache = None
+        if cache_bytes > 0:
+            self.cache = sample_cache(self.stores, self.sample_shapes(), cache_bytes, shared=shared_cache,
+                                      window_n=self.store_frame_length - self.frame_length + 1)
+
+    def sample_shapes(self):
+        return [shape[1:] for shape in self.batch_shapes(1)]
+
+    def batch_shapes(self, batch_size):
+        # shapes of (h, v, disp) batches
+        frames, size = self.frame_length, self.patch_size
+        return [(batch_size, frames, 9, size, size, 3), (batch_size, frames, 9, size, size, 3), (batch_size, frames, size, size)]
+
+    def batch_dtypes(self):
+        image_dtype = np.uint8 if self.uint8_output else np.float32
+        return [image_dtype, image_dtype, np.float32]
+
+    def get_buffers(self, batch_size):
+        if self.buffers is None or len(self.buffers.read[2]) != batch_size:
+            self.buffers = batch_buffers(self.batch_shapes(batch_size), self.batch_shapes(batch_size),
+                                         out_dtypes=self.batch_dtypes())
+        return self.buffers
+
+    def scale(self, seq, out):
+        # uint8 samples -> output batch, in [0, 1] unless the model scales uint8 inputs itself
+        if self.uint8_output:
+            np.copyto(out, seq)
+        else:
+            np.divide(seq, 255.0, out=out, dtype=np.float32)
+
+    def window_start(self):
+        # first frame of the temporal window within the stored patches, chosen before reading so
+        # that only frame_length frames are decoded: random in training, the first frames in validation
+        if self.val_mode or self.store_frame_length == self.frame_length:
+            return 0
+        return np.random.randint(0, self.store_frame_length - self.frame_length + 1)
+
+    def augmentation(self, seq_batch_h, seq_batch_v, seq_batch_disp, out):
+        # whole-batch augmentation of the uint8 (batch, frame, angle, height, width, channel) read
+        # buffers, flipped and rotated in place and written into the out batch through the gamma lookup table
+        batch_size = len(seq_batch_disp)
+        if self.horizontal_flip:
+            flip = np.random.randint(0, 2, batch_size) == 1
+            seq_batch_h[flip] = seq_batch_h[flip][:, :, ::-1, :, ::-1, :]
+            seq_batch_v[flip] = seq_batch_v[flip][:, :,    :, :, ::-1, :]
+            seq_batch_disp[flip] = seq_batch_disp[flip][:, :, :, ::-1]   # (batch, frame, height, width)
+        if self.vertical_flip:
+            flip = np.random.randint(0, 2, batch_size) == 1
+            seq_batch_h[flip] = seq_batch_h[flip][:, :,    :, ::-1, :, :]
+            seq_batch_v[flip] = seq_batch_v[flip][:, :, ::-1, ::-1, :, :]
+            seq_batch_disp[flip] = seq_batch_disp[flip][:, :, ::-1, :]
+        if self.rotation:
+            rot90_n = np.random.randint(0, 4, batch_size)
+            for rot_step in range(1, 4):
+                rot = rot90_n >= rot_step
+                seq_batch_h_rot90 = np.rot90(seq_batch_h[rot], 1, (3, 4))
+                seq_batch_v_rot90 = np.rot90(seq_batch_v[rot], 1, (3, 4))
+                seq_batch_h[rot] = seq_batch_v_rot90[:, :, ::-1]
+                seq_batch_v[rot] = seq_batch_h_rot90
+                seq_batch_disp[rot] = np.rot90(seq_batch_disp[rot], 1, (2, 3))
+        out_h, out_v, out_disp = out
+        np.copyto(out_disp, seq_batch_disp)
+        if not self.gammma:
+            self.scale(seq_batch_h, out_h)
+            self.scale(seq_batch_v, out_v)
+            return
+        # gamma in [0.8, 1.2]: one gather from the flattened lookup table at offset gamma_idx*256 of every sample
+        gamma_idx = np.random.randint(0, len(GAMMA_LUT), batch_size)
+        offsets = (gamma_idx * 256).reshape(-1, 1, 1, 1, 1, 1)
+        gamma_lut = (GAMMA_LUT_UINT8 if self.uint8_output else GAMMA_LUT).ravel()
+        buffers = self.get_buffers(batch_size)
+        if buffers.index is None:
+            buffers.index = np.empty(seq_batch_h.shape, dtype=np.intp)
+        index = buffers.index
+        for seq, out_seq in [(seq_batch_h, out_h), (seq_batch_v, out_v)]:
+            np.add(seq, offsets, out=index)
+            np.take(gamma_lut, index, out=out_seq)
+
+    def make_batch(self, batch_samples, out=None):
+        # out: optional (h, v, disp) arrays of batch_shapes() to write the batch into,
+        # otherwise the next buffer of the output ring
+        buffers = self.get_buffers(len(batch_samples))
+        if out is None:
+            out = buffers.next_out()
+        if self.val_mode and self.uint8_output:
+            # nothing to convert, the samples are read into the batch
+            read_samples(self.stores, batch_samples, *out, start=self.window_start(), cache=self.cache)
+            return [out[0], out[1]], out[2]
+        read_samples(self.stores, batch_samples, *buffers.read, start=self.window_start(), cache=self.cache)
+        seq_batch_h, seq_batch_v, seq_batch_disp = buffers.read
+        if not self.val_mode:
+            self.augmentation(seq_batch_h, seq_batch_v, seq_batch_disp, out)
+        else:
+            self.scale(seq_batch_h, out[0])
+            self.scale(seq_batch_v, out[1])
+            np.copyto(out[2], seq_batch_disp)
+        return [out[0], out[1]], out[2]
+
+    def sampler(self, batch_size=64, seed=None, rank=0, world_size=1):
+        return epoch_sampler(len(self.samples), batch_size, seed, shuffle=not self.val_mode, rank=rank, world_size=world_size)
+
+    def flow_from_directory(self, batch_size=64, seed=None, rank=0, world_size=1, start_step=0, sampler=None):
+        # rank's share of every epoch from the global step start_step, see epoch_sampler;
+        # with an importance_sampler the batches also carry its sample weights
+        sampler = sampler or self.sampler(batch_size, seed, rank, world_size)
+        for batch_indices, batch_seed in sampler.batches(start_step):
+            np.random.seed(batch_seed)
+            inputs, disp = self.make_batch(self.samples[batch_indices])
+            if hasattr(sampler, 'weights'):
+                yield inputs, disp, sampler.weights(batch_indices)
+            else:
+                yield inputs, disp
+
+class multiscale_generator():
+    # Crops of several sizes cut from scene stores, one input_generator_fl5 (bucket) per size with a
+    # stride of half the size. Every batch holds one size, and the batch size of each bucket keeps
+    # batch_size*size*size within pixel_budget, so every batch needs about the same memory.
+    # Each epoch runs through all buckets with their batches in random order (in order with val_mode).
+    # cache_bytes is split over the buckets in proportion to the bytes of their samples.
+    def __init__(self, class_list_path, patch_sizes=(32, 64, 128), pixel_budget=64*32*32, val_mode=False, cache_bytes=0, **kwargs):
+        self.val_mode = val_mode
+        self.patch_sizes = patch_sizes
+        self.buckets = [input_generator_fl5(class_list_path, val_mode=val_mode, patch_size=size, stride=size//2, **kwargs)
+                        for size in patch_sizes]
+        self.batch_sizes = [max(pixel_budget // (size*size), 1) for size in patch_sizes]
+        if cache_bytes > 0:
+            data_bytes = np.array([len(bucket.samples) * sum(np.prod(shape) for shape in bucket.sample_shapes())
+                                   for bucket in self.buckets], dtype=np.float64)
+            for bucket, share in zip(self.buckets, data_bytes / data_bytes.sum()):
+                bucket.set_cache(int(cache_bytes * share))
+
+    def __len__(self):
+        # batches per epoch
+        return sum(len(bucket.samples) // batch_size for bucket, batch_size in zip(self.buckets, self.batch_sizes))
+
+    def flow_from_directory(self, seed=None, start_step=0):
+        # start_step: first batch of the stream, counted over all epochs
+        seed = np.random.randint(2**31) if seed is None else seed
+        samplers = [bucket.sampler(batch_size, seed + i) for i, (bucket, batch_size) in enumerate(zip(self.buckets, self.batch_sizes))]
+        epoch, step = divmod(start_step, len(self))
         while True:
+            order = np.concatenate([np.full(len(sampler), i) for i, sampler in enumerate(samplers)])
             if not self.val_mode:
-                np.random.shuffle(self.data_paths)
-            for target_path in self.data_paths:
-                loaded_data = np.load(target_path)
-                self.seq_h.append(loaded_data['h'])
-                self.seq_v.append(loaded_data['v'])
-                self.seq_disp.append(loaded_data['disp'])
-                if len(self.seq_disp) == batch_size:
-                    seq_batch_h = np.array(self.seq_h, dtype=np.float32) / 255.0
-                    seq_batch_v = np.array(self.seq_v, dtype=np.float32) / 255.0
-                    seq_batch_disp = np.array(self.seq_disp, dtype=np.float32)
-                    seq_batch_h, seq_batch_v, seq_batch_disp = self.convert(seq_batch_h, seq_batch_v, seq_batch_disp)
-                    if not self.val_mode:
-                        seq_batch_h, seq_batch_v, seq_batch_disp = self.augmentation(seq_batch_h, seq_batch_v, seq_batch_disp)
-                    self.clear()
-                    yield [seq_batch_h, seq_batch_v], seq_batch_disp
+                np.random.RandomState([seed, epoch]).shuffle(order)
+            # each bucket continues after its batches among the skipped ones
+            batches = [sampler.epoch_batches(epoch, int(np.count_nonzero(order[:step] == i))) for i, sampler in enumerate(samplers)]
+            for i in order[step:]:
+                batch_indices, batch_seed = next(batches[i])
+                np.random.seed(batch_seed)
+                yield self.buckets[i].make_batch(self.buckets[i].samples[batch_indices])
+            epoch, step = epoch + 1, 0
+
 
 class input_generator_fl3(input_generator_fl5):
-    def convert(self, seq_batch_h, seq_batch_v, seq_batch_disp):
-        if self.val_mode:
-            return seq_batch_h[:,:3], seq_batch_v[:,:3], seq_batch_disp[:,:3]
-        rand = np.random.randint(0,3)
-        return seq_batch_h[:,rand:rand+3], seq_batch_v[:,rand:rand+3], seq_batch_disp[:,rand:rand+3]
+    frame_length = 3
 
 class input_generator_fl4(input_generator_fl5):
-    def convert(self, seq_batch_h, seq_batch_v, seq_batch_disp):
-        if self.val_mode:
-            return seq_batch_h[:,:4], seq_batch_v[:,:4], seq_batch_disp[:,:4]
-        rand = np.random.randint(0,2)
-        return seq_batch_h[:,rand:rand+4], seq_batch_v[:,rand:rand+4], seq_batch_disp[:,rand:rand+4]
+    frame_length = 4
 
 
 class test_generator():
     def __init__(self, class_list_path):
-        self.clear()
-        with open(class_list_path) as f:
-            reader = csv.reader(f)
-            scene_names = np.array([row for row in reader]).flatten()
-        scene_dirs = [pathlib.Path(class_list_path).parent / scene_name
-                        for scene_name in scene_names]
-        self.data_paths = [npz_path for scene_dir in scene_dirs
-                                    for npz_path in scene_dir.glob('*[!full].npz')]
-    
-    def clear(self):
-        self.seq_h = []
-        self.seq_v = []
-        self.seq_disp = []
-        self.taerget_scenes = []
-    
+        self.scene_names, self.stores, self.samples = load_scene_stores(class_list_path)
+        self.frame_length = self.stores[0].frame_length
+        self.patch_size = self.stores[0].patch_size
+
     def flow_from_directory(self, batch_size=64):
-        for target_path in self.data_paths:
-            loaded_data = np.load(target_path)
-            self.seq_h.append(loaded_data['h'])
-            self.seq_v.append(loaded_data['v'])
-            self.seq_disp.append(loaded_data['disp'])
-            self.taerget_scenes.append(re.search(r'[a-z]+_\d', str(target_path)).group())
-            if len(self.seq_disp) == batch_size:
-                seq_batch_h = np.array(self.seq_h, dtype=np.float32) / 255.0
-                seq_batch_v = np.array(self.seq_v, dtype=np.float32) / 255.0
-                seq_batch_disp = np.array(self.seq_disp, dtype=np.float32)
-                scenes_batch = self.taerget_scenes
-                self.clear()
-                yield [seq_batch_h, seq_batch_v], seq_batch_disp, scenes_batch
-        # return remaining data
-        yield [seq_batch_h, seq_batch_v], seq_batch_disp, scenes_batch
\ No newline at end of file
+        # batches are written into reused buffers, copy what has to outlive OUT_RING batches
+        frames, size = self.frame_length, self.patch_size
+        shapes = [(batch_size, frames, 9, size, size, 3), (batch_size, frames, 9, size, size, 3), (batch_size, frames, size, size)]
+        self.buffers = batch_buffers(shapes, shapes)
+        # the last batch holds the remaining data
+        for i in range(0, len(self.samples), batch_size):
+            yield self.make_batch(self.samples[i:i+batch_size])
+
+    def make_batch(self, batch_samples):
+        n = len(batch_samples)
+        seq_batch_h, seq_batch_v, _ = [buffer[:n] for buffer in self.buffers.read]
+        out_h, out_v, out_disp = [buffer[:n] for buffer in self.buffers.next_out()]
+        # disparity needs no conversion, so it is read straight into the output
+        read_samples(self.stores, batch_samples, seq_batch_h, seq_batch_v, out_disp)
+        np.divide(seq_batch_h, 255.0, out=out_h, dtype=np.float32)
+        np.divide(seq_batch_v, 255.0, out=out_v, dtype=np.float32)
+        scenes_batch = [self.scene_names[scene] for scene in batch_samples[:, 0]]
+        return [out_h, out_v], out_disp, scenes_batch
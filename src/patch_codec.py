@@ -0,0 +1,103 @@
+import zlib
+import numpy as np
+
+
+# Patch record codecs
+#
+#   raw     uncompressed frames (stores written with it are memory-mapped instead of decoded)
+#   zlibN   zlib at level N per frame
+#   delta   uint8 frames as differences to the previous frame (the first frame as differences
+#           between neighbouring views), disparity as xor with the previous frame with its
+#           bytes shuffled into planes, then zlib level 1
+#
+# An encoded record is uint32 segment sizes followed by one segment per frame of h, v and disp,
+# so a window of frames can be decoded without the others (except delta, which needs the earlier frames).
+CODECS = ['raw', 'zlib1', 'zlib3', 'zlib6', 'delta']
+
+
+def check_codec(codec):
+    if codec not in CODECS:
+        raise Exception(f'codec must be one of {CODECS}, but receive {codec}.')
+
+
+def _encode_image(codec, frames, t):
+    if codec == 'raw':
+        return np.ascontiguousarray(frames[t]).tobytes()
+    if codec == 'delta':
+        frame = frames[t]
+        if t == 0:
+            delta = np.array(frame)
+            delta[1:] -= frame[:-1]          # neighbouring angular views, uint8 arithmetic wraps
+        else:
+            delta = frame - frames[t-1]      # consecutive frames
+        return zlib.compress(delta, 1)
+    return zlib.compress(np.ascontiguousarray(frames[t]), int(codec[len('zlib'):]))
+
+
+def _decode_image(codec, segment, out, prev):
+    # out: one frame, prev: the decoded previous frame (None for the first frame)
+    if codec == 'raw':
+        out[:] = np.frombuffer(segment, dtype=np.uint8).reshape(out.shape)
+    elif codec == 'delta':
+        delta = np.frombuffer(zlib.decompress(segment), dtype=np.uint8).reshape(out.shape)
+        if prev is None:
+            np.cumsum(delta, axis=0, dtype=np.uint8, out=out)
+        else:
+            np.add(delta, prev, out=out)
+    else:
+        out[:] = np.frombuffer(zlib.decompress(segment), dtype=np.uint8).reshape(out.shape)
+
+
+def _encode_disp(codec, frames, t):
+    if codec != 'delta':
+        return _encode_image(codec, frames, t)
+    bits = np.ascontiguousarray(frames[t]).view(np.uint32)
+    if t > 0:
+        bits = bits ^ np.ascontiguousarray(frames[t-1]).view(np.uint32)
+    return zlib.compress(np.ascontiguousarray(bits.view(np.uint8).reshape(-1, 4).T), 1)
+
+
+def _decode_disp(codec, segment, out, prev):
+    if codec == 'raw':
+        out[:] = np.frombuffer(segment, dtype=np.float32).reshape(out.shape)
+    elif codec == 'delta':
+        shuffled = np.frombuffer(zlib.decompress(segment), dtype=np.uint8).reshape(4, -1)
+        bits = np.ascontiguousarray(shuffled.T).view(np.uint32).reshape(out.shape)
+        if prev is not None:
+            bits = bits ^ prev.view(np.uint32)
+        out[:] = bits.view(np.float32)
+    else:
+        out[:] = np.frombuffer(zlib.decompress(segment), dtype=np.float32).reshape(out.shape)
+
+
+def _decode_frames(codec, decode, segments, out, start):
+    # frames start .. start+len(out)-1 of one array; delta frames depend on every earlier frame,
+    # so those are decoded in place into out[0] first
+    first = 0 if codec == 'delta' else start
+    for t in range(first, start+len(out)):
+        i = max(t - start, 0)
+        prev = None if t == 0 else out[i-1] if t > start else out[0]
+        decode(codec, segments[t], out[i], prev)
+
+
+def encode_patch(codec, h, v, disp):
+    # h, v: (frame, angle, height, width, channel) uint8, disp: (frame, height, width) float32,
+    # or sequences of frames
+    frame_length = len(disp)
+    segments = ([_encode_image(codec, h, t) for t in range(frame_length)] +
+                [_encode_image(codec, v, t) for t in range(frame_length)] +
+                [_encode_disp(codec, disp, t) for t in range(frame_length)])
+    sizes = np.array([len(segment) for segment in segments], dtype=np.uint32)
+    return sizes.tobytes() + b''.join(segments)
+
+
+def decode_patch(codec, record, out_h, out_v, out_disp, frame_length=None, start=0):
+    # decodes frames start .. start+len(out_disp)-1 of a record of frame_length frames
+    # (by default the whole record) into out_*
+    frame_length = frame_length or len(out_disp)
+    sizes = np.frombuffer(record, dtype=np.uint32, count=3*frame_length)
+    offsets = np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)]) + sizes.nbytes
+    segments = [record[offsets[i]:offsets[i+1]] for i in range(3*frame_length)]
+    _decode_frames(codec, _decode_image, segments[:frame_length], out_h, start)
+    _decode_frames(codec, _decode_image, segments[frame_length:2*frame_length], out_v, start)
+    _decode_frames(codec, _decode_disp, segments[2*frame_length:], out_disp, start)
@@ -0,0 +1,338 @@
+import json
+import numpy as np
+import os, pathlib, shutil
+
+# my modules
+from patch_codec import decode_patch
+
+
+# Per-scene stores (one file per scene)
+#
+#   [0, HEADER_SIZE)  MAGIC + json header padded with spaces
+#
+# layout 'patch' (STORE_NAME)
+#   index             int64 (key_frame_n, y_patch_n, x_patch_n): byte offset of every patch record
+#   patches           (h, v, disp) records in (key_frame, iy, ix) order, one chunk per key frame
+#   with a codec other than 'raw' the records are encoded by patch_codec instead:
+#   sizes             uint32 (key_frame_n, y_patch_n, x_patch_n): byte size of every patch record
+#   data              encoded records from header['data_offset'] to the end of the file
+# layout 'scene' (SCENE_STORE_NAME)
+#   h, v              uint8 (frame, angle, height, width, channel): every frame stored once
+#   disp              float32 (frame, height, width)
+#
+# Every array starts on an ALIGN boundary, so it can be opened as an np.memmap and
+# reading a patch is a seek plus a slice.
+MAGIC = b'LFVSTORE'
+HEADER_SIZE = 4096
+ALIGN = 4096
+VERSION = 1
+STORE_NAME = 'patches.lfs'
+SCENE_STORE_NAME = 'scene.lfs'
+
+# Dataset manifest (MANIFEST_NAME in the dataset root), every sample of every scene so that
+# generators can start without opening or scanning scene directories
+#   scenes            scene names, indexed by samples['scene']
+#   samples           MANIFEST_DTYPE rows in (scene, key_frame, iy, ix) order
+MANIFEST_NAME = 'manifest.npz'
+MANIFEST_DTYPE = np.dtype([('scene', np.uint16), ('key_frame', np.uint16), ('iy', np.uint16), ('ix', np.uint16),
+                           ('offset', np.int64)])   # byte offset of the patch record, or of the key frame in a scene store
+
+
+def patch_dtype(frame_length, patch_size):
+    return np.dtype([('h',    np.uint8,   (frame_length, 9, patch_size, patch_size, 3)),  # (frame, angle, height, width, channel)
+                     ('v',    np.uint8,   (frame_length, 9, patch_size, patch_size, 3)),
+                     ('disp', np.float32, (frame_length,    patch_size, patch_size))])    # (frame, height, width)
+
+
+def patch_grid(frame_n, h_size, w_size, frame_length, patch_size=32, stride=16):
+    # (key_frame_n, y_patch_n, x_patch_n)
+    return (max(frame_n - (frame_length-1), 0),
+            (h_size - (patch_size-stride)) // stride,
+            (w_size - (patch_size-stride)) // stride)
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def create_store(path, arrays, **meta):
+    # arrays: {name: (dtype, shape)}, laid out in the given order
+    offset = HEADER_SIZE
+    header = {'version': VERSION, **meta, 'arrays': {}}
+    for name, (dtype, shape) in arrays.items():
+        dtype = np.dtype(dtype)
+        header['arrays'][name] = {'descr': np.lib.format.dtype_to_descr(dtype),
+                                  'shape': [int(n) for n in shape],
+                                  'offset': offset}
+        offset = _align(offset + dtype.itemsize * int(np.prod(shape)))
+    header['data_offset'] = offset
+    encoded = json.dumps(header).encode()
+    if len(MAGIC) + len(encoded) > HEADER_SIZE:
+        raise Exception(f'store header is {len(encoded)} bytes, but must fit in {HEADER_SIZE - len(MAGIC)} bytes.')
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(MAGIC + encoded.ljust(HEADER_SIZE - len(MAGIC)))
+        f.truncate(offset)
+    return header
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        raw = f.read(HEADER_SIZE)
+    if raw[:len(MAGIC)] != MAGIC:
+        raise Exception(f'{path} is not a patch store.')
+    header = json.loads(raw[len(MAGIC):].decode())
+    if header['version'] > VERSION:
+        raise Exception(f'{path} has store version {header["version"]}, but this code reads up to {VERSION}.')
+    return header
+
+
+def open_arrays(path, mode='r'):
+    header = read_header(path)
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        arrays[name] = np.memmap(path, mode=mode, offset=spec['offset'], shape=tuple(spec['shape']),
+                                 dtype=np.lib.format.descr_to_dtype(spec['descr']))
+    return header, arrays
+
+
+def sliding_patches(seq, key_frame_idx, frame_length, patch_size, stride, y_patch_n, x_patch_n, y_axis):
+    # zero-copy view (iy, ix, frame, ..., y, x, ...) of every patch of one key frame window
+    window = seq[key_frame_idx:key_frame_idx+frame_length]
+    strides = window.strides
+    shape = window.shape
+    view_shape = (y_patch_n, x_patch_n) + shape[:y_axis] + (patch_size, patch_size) + shape[y_axis+2:]
+    view_strides = (strides[y_axis]*stride, strides[y_axis+1]*stride) + strides
+    return np.lib.stride_tricks.as_strided(window, shape=view_shape, strides=view_strides, writeable=False)
+
+
+def create_patch_store(path, frame_n, h_size, w_size, frame_length, patch_size=32, stride=16):
+    key_frame_n, y_patch_n, x_patch_n = patch_grid(frame_n, h_size, w_size, frame_length, patch_size, stride)
+    record = patch_dtype(frame_length, patch_size)
+    header = create_store(path, {'index': (np.int64, (key_frame_n, y_patch_n, x_patch_n)),
+                                 'patches': (record, (key_frame_n, y_patch_n, x_patch_n))},
+                          layout='patch', codec='raw', frame_length=frame_length, patch_size=patch_size, stride=stride)
+    _, arrays = open_arrays(path, mode='r+')
+    patches_offset = header['arrays']['patches']['offset']
+    arrays['index'][:] = patches_offset + record.itemsize * np.arange(key_frame_n*y_patch_n*x_patch_n).reshape(key_frame_n, y_patch_n, x_patch_n)
+    arrays['index'].flush()
+    return header
+
+
+def write_patch_window(header, arrays, ring_v, ring_h, ring_disp, key_frame_idx, first_slot, depth):
+    # ring_* are `depth` frames deep (at least frame_length) and hold the frame_length frames of one
+    # key frame window in slots (first_slot + n) % depth
+    frame_length = header['frame_length']
+    patch_size = header['patch_size']
+    stride = header['stride']
+    _, y_patch_n, x_patch_n = arrays['index'].shape
+    chunk = arrays['patches'][key_frame_idx]
+    n = min(frame_length, depth - first_slot)  # frames before the ring wraps around
+    for field, ring, y_axis in [('h', ring_h, 2), ('v', ring_v, 2), ('disp', ring_disp, 1)]:
+        chunk[field][:, :, :n] = sliding_patches(ring, first_slot, n, patch_size, stride, y_patch_n, x_patch_n, y_axis=y_axis)
+        if n < frame_length:
+            chunk[field][:, :, n:] = sliding_patches(ring, 0, frame_length-n, patch_size, stride, y_patch_n, x_patch_n, y_axis=y_axis)
+
+
+class EncodedPartWriter():
+    # encoded records of consecutive key frames written by one build job,
+    # joined into the store by write_encoded_patch_store
+    def __init__(self, part_path):
+        self.part_path = part_path
+        self.f = open(part_path, 'wb')
+        self.sizes = []
+
+    def write(self, records):
+        for record in records:
+            self.f.write(record)
+            self.sizes.append(len(record))
+
+    def close(self):
+        self.f.close()
+        np.save(f'{self.part_path}.sizes.npy', np.array(self.sizes, dtype=np.uint32))
+
+
+def write_encoded_patch_store(path, part_paths, frame_n, h_size, w_size, codec, frame_length, patch_size=32, stride=16):
+    shape = patch_grid(frame_n, h_size, w_size, frame_length, patch_size, stride)
+    sizes = np.concatenate([np.load(f'{part_path}.sizes.npy') for part_path in part_paths]).reshape(shape)
+    # write to a temporary file first, so the store only appears once it is complete
+    tmp_path = pathlib.Path(f'{path}.tmp')
+    header = create_store(tmp_path, {'index': (np.int64, shape), 'sizes': (np.uint32, shape)},
+                          layout='patch', codec=codec, frame_length=frame_length, patch_size=patch_size, stride=stride)
+    _, arrays = open_arrays(tmp_path, mode='r+')
+    arrays['sizes'][:] = sizes
+    arrays['index'][:] = header['data_offset'] + (np.cumsum(sizes.ravel(), dtype=np.int64) - sizes.ravel()).reshape(shape)
+    for array in arrays.values():
+        array.flush()
+    del arrays
+    with open(tmp_path, 'r+b') as f:
+        f.seek(header['data_offset'])
+        for part_path in part_paths:
+            with open(part_path, 'rb') as part:
+                shutil.copyfileobj(part, f)
+    os.replace(tmp_path, path)
+    remove_parts(part_paths)
+
+
+def remove_parts(part_paths):
+    # parts already removed by an interrupted finalization are skipped
+    for part_path in part_paths:
+        for path in [part_path, f'{part_path}.sizes.npy']:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def create_scene_store(path, frame_n, h_size, w_size):
+    return create_store(path, {'h': (np.uint8, (frame_n, 9, h_size, w_size, 3)),
+                               'v': (np.uint8, (frame_n, 9, h_size, w_size, 3)),
+                               'disp': (np.float32, (frame_n, h_size, w_size))},
+                        layout='scene')
+
+
+def write_scene_chunk(header, arrays, seq_v, seq_h, seq_disp, frame_start):
+    frame_stop = frame_start + len(seq_disp)
+    arrays['h'][frame_start:frame_stop] = seq_h
+    arrays['v'][frame_start:frame_stop] = seq_v
+    arrays['disp'][frame_start:frame_stop] = seq_disp
+
+
+class PatchStore():
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.header, self.arrays = open_arrays(self.path)
+        self.codec = self.header.get('codec', 'raw')
+        self.frame_length = self.header['frame_length']
+        self.patch_size = self.header['patch_size']
+        self.stride = self.header['stride']
+        self.index = self.arrays['index']
+        if self.codec == 'raw':
+            patches = self.arrays['patches']
+            # field views of the memmap, indexing them does not copy
+            self.h = patches['h']
+            self.v = patches['v']
+            self.disp = patches['disp']
+        else:
+            self.sizes = self.arrays['sizes']
+            self.data = np.memmap(self.path, mode='r', dtype=np.uint8)
+
+    @property
+    def shape(self):
+        # (key_frame_n, y_patch_n, x_patch_n)
+        return self.index.shape
+
+    def __len__(self):
+        return self.index.size
+
+    def __getitem__(self, key):
+        # key: (key_frame, iy, ix)
+        if self.codec == 'raw':
+            return self.h[key], self.v[key], self.disp[key]
+        frame_length, patch_size = self.frame_length, self.patch_size
+        h = np.empty((frame_length, 9, patch_size, patch_size, 3), dtype=np.uint8)
+        v = np.empty((frame_length, 9, patch_size, patch_size, 3), dtype=np.uint8)
+        disp = np.empty((frame_length, patch_size, patch_size), dtype=np.float32)
+        self.read(key, h, v, disp)
+        return h, v, disp
+
+    def read(self, key, out_h, out_v, out_disp, start=0):
+        # decodes (or copies) frames start .. start+len(out_disp)-1 of patch `key` into preallocated arrays
+        frames = slice(start, start+len(out_disp))
+        if self.codec == 'raw':
+            np.copyto(out_h, self.h[key][frames])
+            np.copyto(out_v, self.v[key][frames])
+            np.copyto(out_disp, self.disp[key][frames])
+            return
+        offset = self.index[key]
+        decode_patch(self.codec, self.data[offset:offset+self.sizes[key]], out_h, out_v, out_disp,
+                     frame_length=self.frame_length, start=start)
+
+
+class SceneStore():
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.header, self.arrays = open_arrays(self.path)
+        self.h = self.arrays['h']
+        self.v = self.arrays['v']
+        self.disp = self.arrays['disp']
+
+    @property
+    def frame_n(self):
+        return len(self.disp)
+
+
+def open_store(scene_dir):
+    scene_dir = pathlib.Path(scene_dir)
+    if (scene_dir / STORE_NAME).exists():
+        return PatchStore(scene_dir / STORE_NAME)
+    if (scene_dir / SCENE_STORE_NAME).exists():
+        return SceneStore(scene_dir / SCENE_STORE_NAME)
+    raise Exception(f'no patch store ({STORE_NAME}) or scene store ({SCENE_STORE_NAME}) in {scene_dir}.')
+
+
+def write_manifest(root, scene_names, frame_length, patch_size=32, stride=16):
+    root = pathlib.Path(root)
+    samples = []
+    for i, scene_name in enumerate(scene_names):
+        store = open_store(root / scene_name)
+        if isinstance(store, PatchStore):
+            offsets = store.index
+        else:
+            frame_n, _, h_size, w_size, _ = store.h.shape
+            shape = patch_grid(frame_n, h_size, w_size, frame_length, patch_size, stride)
+            frame_offsets = store.header['arrays']['h']['offset'] + store.h[0].nbytes * np.arange(shape[0])
+            offsets = np.broadcast_to(frame_offsets[:, None, None], shape)
+        rows = np.zeros(offsets.size, dtype=MANIFEST_DTYPE)
+        rows['scene'] = i
+        rows['key_frame'], rows['iy'], rows['ix'] = np.indices(offsets.shape).reshape(3, -1)
+        rows['offset'] = offsets.ravel()
+        samples.append(rows)
+    tmp_path = (root / MANIFEST_NAME).with_suffix('.tmp.npz')
+    np.savez(tmp_path, scenes=np.array(scene_names), samples=np.concatenate(samples),
+             frame_length=frame_length, patch_size=patch_size, stride=stride)
+    os.replace(tmp_path, root / MANIFEST_NAME)
+
+
+def check_patch_window(frame_n=9, h_size=48, w_size=64, frame_length=5):
+    # regression check of write_patch_window: patches written from a frame_length deep ring
+    # (--streaming) and from a ring holding every frame equal direct slices of the frames
+    import tempfile
+    rng = np.random.RandomState(0)
+    seq_v = rng.randint(0, 256, (frame_n, 9, h_size, w_size, 3)).astype(np.uint8)
+    seq_h = rng.randint(0, 256, (frame_n, 9, h_size, w_size, 3)).astype(np.uint8)
+    seq_disp = rng.rand(frame_n, h_size, w_size).astype(np.float32)
+    for depth in [frame_length, frame_n]:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = pathlib.Path(tmp_dir) / STORE_NAME
+            header = create_patch_store(path, frame_n, h_size, w_size, frame_length)
+            _, arrays = open_arrays(path, mode='r+')
+            ring_v, ring_h, ring_disp = [np.zeros((depth,) + seq.shape[1:], seq.dtype) for seq in [seq_v, seq_h, seq_disp]]
+            for i in range(frame_n):
+                for ring, seq in [(ring_v, seq_v), (ring_h, seq_h), (ring_disp, seq_disp)]:
+                    ring[i % depth] = seq[i]
+                if i >= frame_length - 1:
+                    key_frame_idx = i - (frame_length - 1)
+                    write_patch_window(header, arrays, ring_v, ring_h, ring_disp, key_frame_idx, key_frame_idx % depth, depth)
+            store = PatchStore(path)
+            for key in np.ndindex(store.shape):
+                key_frame, iy, ix = key
+                t = slice(key_frame, key_frame + frame_length)
+                y = slice(iy*store.stride, iy*store.stride + store.patch_size)
+                x = slice(ix*store.stride, ix*store.stride + store.patch_size)
+                h, v, disp = store[key]
+                if not (np.array_equal(h, seq_h[t, :, y, x]) and np.array_equal(v, seq_v[t, :, y, x]) and np.array_equal(disp, seq_disp[t, y, x])):
+                    raise Exception(f'patch {key} written from a ring {depth} frames deep differs from the frames.')
+            patch_n = len(store)
+            del arrays, store
+        print(f'ring depth {depth}: {patch_n} patches match the frames')
+
+
+def load_manifest(root):
+    with np.load(pathlib.Path(root) / MANIFEST_NAME) as f:
+        manifest = {key: f[key] for key in f.files}
+    manifest['scenes'] = [str(scene_name) for scene_name in manifest['scenes']]
+    return manifest
+
+
+if __name__ == "__main__":
+    check_patch_window()
@@ -0,0 +1,111 @@
+import collections
+import multiprocessing as mp
+import numpy as np
+
+
+class sample_cache():
+    # LRU cache of decoded uint8 samples (the h, v, disp window read from a store) with a byte budget,
+    # keyed by (scene, key_frame, iy, ix, window start).
+    #   shared=False  entries are arrays in a dict of this process
+    #   shared=True   entries are fixed slots in shared memory, so the prefetch_loader workers forked
+    #                 after the cache was created share one cache; the slot table is guarded by a lock
+    # stats() returns the hit/miss counters to size budget against the node's RAM.
+    def __init__(self, stores, sample_shapes, budget, shared=False, window_n=1):
+        # sample_shapes: (h, v, disp) shapes of one sample, window_n: possible window starts per sample
+        self.stores = stores
+        self.sample_shapes = sample_shapes
+        self.budget = budget
+        self.shared = shared
+        self.window_n = window_n
+        dtypes = [np.uint8, np.uint8, np.float32]
+        self.sample_bytes = [int(np.prod(shape)) * np.dtype(dtype).itemsize for shape, dtype in zip(sample_shapes, dtypes)]
+        self.entry_bytes = sum(self.sample_bytes)
+        if not shared:
+            self.entries = collections.OrderedDict()
+            self.counters = np.zeros(2, dtype=np.int64)   # hits, misses
+            return
+        # sample id -> slot, through the position of the sample in its store
+        self.scene_offsets = np.cumsum([0] + [len(store) for store in stores])
+        self.slot_n = budget // self.entry_bytes
+        ctx = mp.get_context('fork')
+        self.lock = ctx.Lock()
+        self.data = ctx.RawArray('b', max(self.slot_n, 1) * self.entry_bytes)
+        self.slot_of = np.frombuffer(ctx.RawArray('i', int(self.scene_offsets[-1]) * window_n), dtype=np.int32)
+        self.slot_of[:] = -1
+        self.slot_id = np.frombuffer(ctx.RawArray('q', max(self.slot_n, 1)), dtype=np.int64)
+        self.slot_id[:] = -1
+        self.slot_tick = np.frombuffer(ctx.RawArray('q', max(self.slot_n, 1)), dtype=np.int64)
+        self.counters = np.frombuffer(ctx.RawArray('q', 3), dtype=np.int64)   # hits, misses, tick
+        self.slots = []
+        for slot in range(self.slot_n):
+            offset = slot * self.entry_bytes
+            arrays = []
+            for shape, dtype, nbytes in zip(sample_shapes, dtypes, self.sample_bytes):
+                arrays.append(np.frombuffer(self.data, dtype=dtype, count=nbytes // np.dtype(dtype).itemsize,
+                                            offset=offset).reshape(shape))
+                offset += nbytes
+            self.slots.append(arrays)
+
+    def sample_id(self, scene, key, start):
+        return (self.scene_offsets[scene] + np.ravel_multi_index(key, self.stores[scene].shape)) * self.window_n + start
+
+    def read(self, scene, key, out_h, out_v, out_disp, start=0):
+        # same as stores[scene].read(key, out_h, out_v, out_disp, start), through the cache
+        out = [out_h, out_v, out_disp]
+        if self.shared:
+            self._read_shared(scene, key, out, start)
+            return
+        entry_key = (scene, *key, start)
+        entry = self.entries.get(entry_key)
+        if entry is not None:
+            self.entries.move_to_end(entry_key)
+            self.counters[0] += 1
+            for dst, src in zip(out, entry):
+                np.copyto(dst, src)
+            return
+        self.counters[1] += 1
+        self.stores[scene].read(key, out_h, out_v, out_disp, start)
+        if self.entry_bytes > self.budget:
+            return
+        while (len(self.entries) + 1) * self.entry_bytes > self.budget:
+            self.entries.popitem(last=False)
+        self.entries[entry_key] = [np.copy(array) for array in out]
+
+    def _read_shared(self, scene, key, out, start):
+        sample_id = self.sample_id(scene, key, start)
+        with self.lock:
+            slot = self.slot_of[sample_id]
+            if slot >= 0:
+                self.counters[0] += 1
+                self.counters[2] += 1
+                self.slot_tick[slot] = self.counters[2]
+                for dst, src in zip(out, self.slots[slot]):
+                    np.copyto(dst, src)
+                return
+            self.counters[1] += 1
+        # decode outside the lock, then evict the least recently used slot
+        self.stores[scene].read(key, *out, start)
+        if self.slot_n == 0:
+            return
+        with self.lock:
+            if self.slot_of[sample_id] >= 0:
+                return   # another worker cached it meanwhile
+            slot = int(np.argmin(self.slot_tick))
+            if self.slot_id[slot] >= 0:
+                self.slot_of[self.slot_id[slot]] = -1
+            for dst, src in zip(self.slots[slot], out):
+                np.copyto(dst, src)
+            self.counters[2] += 1
+            self.slot_tick[slot] = self.counters[2]
+            self.slot_id[slot] = sample_id
+            self.slot_of[sample_id] = slot
+
+    def __len__(self):
+        if self.shared:
+            return int(np.count_nonzero(self.slot_id >= 0))
+        return len(self.entries)
+
+    def stats(self):
+        hits, misses = int(self.counters[0]), int(self.counters[1])
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / max(hits + misses, 1),
+                'entries': len(self), 'bytes': len(self) * self.entry_bytes, 'budget': self.budget}
@@ -0,0 +1,125 @@
+import threading
+import numpy as np
+
+
+class epoch_sampler():
+    # Batches of sample indices computed only from (seed, epoch), so every rank and loader worker
+    # can derive its own share of an epoch without coordination and training can restart at any step.
+    #   epoch permutation  RandomState([seed, epoch]).permutation(sample_n), identity without shuffle
+    #   global step        world_size consecutive batches of the permutation, rank r takes the r-th;
+    #                      the remainder of an epoch that does not fill a global step is dropped
+    #   batch seed         per-batch seed for augmentation, also from (seed, epoch), so a batch does not
+    #                      depend on which process assembles it
+    def __init__(self, sample_n, batch_size=64, seed=None, shuffle=True, rank=0, world_size=1):
+        if not 0 <= rank < world_size:
+            raise Exception(f'rank must be an integer between 0 and {world_size-1}, but receive {rank}.')
+        self.sample_n = sample_n
+        self.batch_size = batch_size
+        self.seed = np.random.randint(2**31) if seed is None else seed
+        self.shuffle = shuffle
+        self.rank = rank
+        self.world_size = world_size
+
+    def __len__(self):
+        # steps per epoch
+        return self.sample_n // (self.batch_size * self.world_size)
+
+    def epoch_batches(self, epoch, start_step=0):
+        # (sample indices, batch seed) of this rank for the steps start_step.. of the epoch
+        rng = np.random.RandomState([self.seed, epoch])
+        order = rng.permutation(self.sample_n) if self.shuffle else np.arange(self.sample_n)
+        batch_seeds = rng.randint(2**31, size=len(self) * self.world_size)
+        for step in range(start_step, len(self)):
+            batch = step * self.world_size + self.rank
+            yield order[batch*self.batch_size:(batch+1)*self.batch_size], batch_seeds[batch]
+
+    def get_state(self):
+        # what a resumed run needs to continue the same batches (see checkpoint.py)
+        return {'seed': self.seed}
+
+    def set_state(self, state):
+        self.seed = int(state['seed'])
+
+    def batches(self, start_step=0):
+        # endless batches from the global step start_step (counted over all epochs)
+        if len(self) == 0:
+            raise Exception(f'{self.sample_n} samples do not fill one step of {self.world_size} batches of {self.batch_size}.')
+        epoch, step = divmod(start_step, len(self))
+        while True:
+            yield from self.epoch_batches(epoch, step)
+            epoch, step = epoch + 1, 0
+
+
+class importance_sampler(epoch_sampler):
+    # Draws training samples in proportion to a per-sample loss estimate instead of uniformly.
+    #   scores       exponential moving average of the loss of every scored sample (update());
+    #                samples never scored count as the mean of the scored ones
+    #   uniform_mix  share of uniform probability mixed in, so every sample keeps p >= uniform_mix / sample_n
+    #   weights      1 / (sample_n * p) for the drawn samples, so the weighted loss stays an unbiased
+    #                estimate of the mean loss over all samples (and weights <= 1 / uniform_mix)
+    # Draws are made with replacement from a snapshot of the probabilities per epoch: snapshot(epoch)
+    # is taken by importance_scoring right after it scored the previous epoch, and the draws of an epoch
+    # are made from its snapshot when its first batch is pulled. A consumer pulling ahead (prefetch)
+    # waits for the snapshot, so the draws do not depend on prefetch depth and a resumed run draws
+    # the same batches. Ranks need the same scores to draw disjoint slices of the same epoch.
+    def __init__(self, sample_n, batch_size=64, seed=None, rank=0, world_size=1, uniform_mix=0.1, momentum=0.5):
+        super().__init__(sample_n, batch_size, seed, shuffle=True, rank=rank, world_size=world_size)
+        self.uniform_mix = uniform_mix
+        self.momentum = momentum
+        self.scores = np.zeros(sample_n, dtype=np.float32)
+        self.scored = np.zeros(sample_n, dtype=bool)
+        # snapshot of the probabilities of the epochs from probs_epoch on, and the ones of the epoch being drawn
+        self.probs = np.full(sample_n, 1 / sample_n)
+        self.probs_epoch = 0
+        self.draw_probs = self.probs
+        self.snapshot_taken = threading.Condition()
+
+    def update(self, indices, losses):
+        first = ~self.scored[indices]
+        self.scores[indices] = np.where(first, losses, self.momentum*self.scores[indices] + (1-self.momentum)*losses)
+        self.scored[indices] = True
+
+    def get_state(self):
+        return {'seed': self.seed, 'scores': self.scores, 'scored': self.scored,
+                'probs': self.probs, 'probs_epoch': self.probs_epoch}
+
+    def set_state(self, state):
+        self.seed = int(state['seed'])
+        self.scores[:] = state['scores']
+        self.scored[:] = state['scored']
+        with self.snapshot_taken:
+            self.probs = np.array(state['probs'])
+            self.probs_epoch = int(state['probs_epoch'])
+            self.snapshot_taken.notify_all()
+
+    def snapshot(self, epoch):
+        # fixes the probabilities epoch `epoch` (and later ones until the next snapshot) draws from
+        with self.snapshot_taken:
+            self.probs = self.probabilities()
+            self.probs_epoch = epoch
+            self.snapshot_taken.notify_all()
+
+    def probabilities(self):
+        if not self.scored.any():
+            return np.full(self.sample_n, 1 / self.sample_n)
+        scores = np.where(self.scored, self.scores, self.scores[self.scored].mean()).astype(np.float64)
+        if scores.sum() <= 0:
+            return np.full(self.sample_n, 1 / self.sample_n)
+        return (1 - self.uniform_mix) * scores / scores.sum() + self.uniform_mix / self.sample_n
+
+    def epoch_batches(self, epoch, start_step=0):
+        # generator body, so the draws are made when the first batch is pulled
+        with self.snapshot_taken:
+            self.snapshot_taken.wait_for(lambda: self.probs_epoch >= epoch)
+            self.draw_probs = self.probs
+        rng = np.random.RandomState([self.seed, epoch])
+        batch_n = len(self) * self.world_size
+        draws = rng.choice(self.sample_n, size=batch_n * self.batch_size, p=self.draw_probs)
+        batch_seeds = rng.randint(2**31, size=batch_n)
+        for step in range(start_step, len(self)):
+            batch = step * self.world_size + self.rank
+            yield draws[batch*self.batch_size:(batch+1)*self.batch_size], batch_seeds[batch]
+
+    def weights(self, indices):
+        # importance weights of samples drawn in the current epoch
+        return (1 / (self.sample_n * self.draw_probs[indices])).astype(np.float32)
@@ -1,6 +1,24 @@
 from tensorflow.keras.layers import Input, Conv3D
 from tensorflow.keras.models import Model
 import numpy as np
+import tensorflow as tf
+
+
+edge_kx = np.array([[1, 0, -1], 
+                    [2, 0, -2], 
+                    [1, 0, -1]])
+edge_ky = np.array([[1, 2, 1], 
+                    [0, 0, 0], 
+                    [-1, -2, -1]])
+EDGE_K = np.transpose(np.stack((edge_kx, edge_ky)), (1,2,0)).reshape(1, 3, 3, 1, 2).astype(np.float32)
+
+
+def get_gradient(x):
+    # Sobel.get_gradient as a convolution with a constant kernel, so it compiles into the graph of its caller
+    # x: (batch, frame, height, width[, 1]) -> (batch, frame, height-2, width-2, 2)
+    if len(x.shape) == 4:
+        x = tf.expand_dims(x, axis=-1)
+    return tf.nn.conv3d(x, tf.constant(EDGE_K, dtype=x.dtype), strides=[1, 1, 1, 1, 1], padding='VALID')
 
 
 class Sobel():
@@ -8,17 +26,7 @@ class Sobel():
         inputs = Input(shape=((None, None, None, 1)))
         x = Conv3D(filters=2, kernel_size=(1,3,3), padding='valid', use_bias=False)(inputs)
         self.edge_conv = Model(inputs=inputs, outputs=x)
-
-        edge_kx = np.array([[1, 0, -1], 
-                            [2, 0, -2], 
-                            [1, 0, -1]])
-        edge_ky = np.array([[1, 2, 1], 
-                            [0, 0, 0], 
-                            [-1, -2, -1]])
-        edge_k = np.stack((edge_kx, edge_ky))
-
-        edge_k = np.transpose(edge_k, (1,2,0)).reshape(1, 3, 3, 1, 2)
-        self.edge_conv.layers[1].set_weights([edge_k])
+        self.edge_conv.layers[1].set_weights([EDGE_K])
         # self.edge_conv.trainable = False
         # self.edge_conv.compile(optimizer="adam", loss="mse")
         # self.edge_conv.summary()
@@ -1,37 +1,99 @@
 import pathlib, datetime
+import numpy as np
+import tensorflow.keras.backend as K
 from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.callbacks import ModelCheckpoint, LearningRateScheduler, CSVLogger
+from tensorflow.keras.callbacks import Callback, ModelCheckpoint, LearningRateScheduler, CSVLogger, LambdaCallback
 
 # my modules
 from mygenerator import *
+from loader import prefetch_loader
+from mydataset import input_dataset
 from loss import get_loss_function
+from sampler import importance_sampler
+from checkpoint import load_checkpoint, restore_checkpoint, training_checkpoint
+from train_loop import compiled_trainer
+
+
+def parse_affinity(affinity):
+    # 'auto' (one core per worker), or cpu lists per worker separated by ':', e.g. '0,1:2,3'
+    if affinity is None or affinity == 'auto':
+        return affinity
+    return [{int(cpu) for cpu in cpus.split(',')} for cpus in affinity.split(':')]
+
+
+class importance_scoring(Callback):
+    # After every epoch, scores a share of the training samples (the ones never scored first) without
+    # augmentation, feeds their per-sample losses to the importance sampler and takes its snapshot of
+    # the probabilities the next epoch draws from.
+    def __init__(self, datagen, sampler, loss_function, fraction=0.1, batch_size=64, seed=0):
+        super().__init__()
+        self.datagen = datagen
+        self.sampler = sampler
+        self.loss_function = loss_function
+        self.score_n = max(int(len(datagen.samples) * fraction) // batch_size, 1) * batch_size
+        self.batch_size = batch_size
+        self.seed = seed
+
+    def on_epoch_end(self, epoch, logs=None):
+        rng = np.random.RandomState([self.seed, epoch])
+        scored = self.sampler.scored
+        indices = np.concatenate([rng.permutation(np.flatnonzero(~scored)), rng.permutation(np.flatnonzero(scored))])
+        indices = indices[:self.score_n]
+        for i in range(0, len(indices) - self.batch_size + 1, self.batch_size):
+            batch_indices = indices[i:i+self.batch_size]
+            inputs, disp = self.datagen.make_batch(self.datagen.samples[batch_indices])
+            pred = self.model.predict_on_batch(inputs)
+            losses = K.eval(self.loss_function(K.constant(disp), K.constant(pred)))
+            self.sampler.update(batch_indices, losses)
+        # the probabilities of the next epoch, whenever its batches are pulled
+        self.sampler.snapshot(epoch + 1)
+        print(f'importance sampling: {int(scored.sum())}/{len(scored)} samples scored, '
+              f'max weight {1 / (len(scored) * self.sampler.probs.min()):.2f}')
 
 
 def train(model, args):
     # model compile
     lr = 0.0005
     optimizer = Adam(lr=lr)
-    model.compile(optimizer=optimizer, loss=get_loss_function())
+    loss_function = get_loss_function()
+    model.compile(optimizer=optimizer, loss=loss_function)
 
     # data generator
-    if args.frame_length == 5:
-        input_generator = input_generator_fl5
-    elif args.frame_length == 4:
-        input_generator = input_generator_fl4
-    elif args.frame_length == 3:
-        input_generator = input_generator_fl3
+    batch_size = 64
+    patch_sizes = [int(size) for size in args.patch_sizes.split(',')]
+    ## uint8 h, v batches for models built with uint8_inputs
+    if args.tf_data:
+        train_datagen = input_dataset(args.train_list, args.frame_length)
+        valid_datagen = input_dataset(args.valid_list, args.frame_length)
     else:
-        raise Exception(f'args.frame_length must be an integer between 3 and 5, but receive {args.frame_length}.')
-    train_datagen = input_generator(args.train_list)
-    valid_datagen = input_generator(args.valid_list, val_mode=True)
+        # windows up to the stored frame_length of patch stores, any length with scene stores
+        # decoded samples are cached in RAM (shared by the loader processes) if a cache size is given
+        if patch_sizes == [32]:
+            train_datagen = input_generator_fl5(args.train_list, frame_length=args.frame_length,
+                                                cache_bytes=int(args.train_cache_gb * 2**30), shared_cache=args.workers > 0,
+                                                uint8_output=args.uint8_inputs)
+        valid_datagen = input_generator_fl5(args.valid_list, val_mode=True, frame_length=args.frame_length,
+                                            cache_bytes=int(args.valid_cache_gb * 2**30), shared_cache=args.workers > 0,
+                                            uint8_output=args.uint8_inputs)
+    if patch_sizes != [32]:
+        # multi-scale crops of the scene stores in batches of about batch_size 32x32 patches worth of pixels,
+        # validated on 32x32 patches as before
+        if args.tf_data or args.workers > 0 or args.importance_sampling:
+            raise Exception('--patch_sizes needs the in-process generator (no --tf_data, --workers or --importance_sampling).')
+        train_datagen = multiscale_generator(args.train_list, patch_sizes, pixel_budget=batch_size*32*32, frame_length=args.frame_length,
+                                             cache_bytes=int(args.train_cache_gb * 2**30), uint8_output=args.uint8_inputs)
 
     # callbacks
-    now = datetime.datetime.now().strftime("%Y-%m-%d_%H%M")
-    output = pathlib.Path(f'../output/{now}_{args.model_name}_fl{args.frame_length}_{args.memo}')
+    if args.resume:
+        # continue in the output directory of the interrupted run
+        output = pathlib.Path(args.resume)
+    else:
+        now = datetime.datetime.now().strftime("%Y-%m-%d_%H%M")
+        output = pathlib.Path(f'../output/{now}_{args.model_name}_fl{args.frame_length}_{args.memo}')
     output.mkdir(exist_ok=True, parents=True)
     cp = ModelCheckpoint(filepath = f'{output}/weights.h5', monitor='val_loss',
             save_best_only=True, save_weights_only=True, verbose=0, mode='auto')
-    logger = CSVLogger(f'{output}/history.csv')
+    logger = CSVLogger(f'{output}/history.csv', append=bool(args.resume))
     ## learning rate
     def step_decay(epoch):
         factor = 1
@@ -39,18 +101,100 @@ def train(model, args):
         if epoch >= 15: factor = 0.01
         return lr * factor
     lr_schedule = LearningRateScheduler(step_decay, verbose=1)
+    callbacks = [cp, logger, lr_schedule]
+    ## sample cache counters
+    for name, datagen in [('train', train_datagen), ('valid', valid_datagen)]:
+        if getattr(datagen, 'cache', None) is not None:
+            callbacks.append(LambdaCallback(on_epoch_end=lambda epoch, logs, name=name, cache=datagen.cache:
+                                            print(f'{name} sample cache: {cache.stats()}')))
 
     # START training
-    batch_size = 64
     epochs = 20
-    model.fit_generator(
-        generator=train_datagen.flow_from_directory(batch_size),
-        steps_per_epoch=len(train_datagen.data_paths) // batch_size,
-        epochs=epochs,
-        initial_epoch=0,
-        verbose=1,
-        callbacks=[cp, logger, lr_schedule],
-        validation_data=valid_datagen.flow_from_directory(batch_size),
-        validation_steps=len(valid_datagen.data_paths) // batch_size,
-        max_queue_size=20
-    )
\ No newline at end of file
+    ## training state of the interrupted run, or a new batch stream
+    checkpoint = load_checkpoint(output / 'checkpoint.npz') if args.resume else None
+    if checkpoint is not None:
+        seed, initial_epoch, start_step = [checkpoint['state'][key] for key in ['seed', 'epoch', 'step']]
+    else:
+        seed, initial_epoch, start_step = int(np.random.randint(2**31)), 0, 0
+    ## batches of the training samples from the seed, importance sampling draws them by their loss
+    sampler = None
+    if args.importance_sampling:
+        if args.tf_data:
+            raise Exception('importance sampling needs the generator data loading, not --tf_data.')
+        sampler = importance_sampler(len(train_datagen.samples), batch_size, seed=seed)
+        score_datagen = input_generator_fl5(args.train_list, val_mode=True, frame_length=args.frame_length,
+                                            uint8_output=args.uint8_inputs)
+        callbacks.append(importance_scoring(score_datagen, sampler, loss_function, args.score_fraction, batch_size))
+    elif not args.tf_data and not isinstance(train_datagen, multiscale_generator):
+        sampler = train_datagen.sampler(batch_size, seed)
+    if isinstance(train_datagen, multiscale_generator):
+        steps_per_epoch = len(train_datagen)
+    else:
+        steps_per_epoch = len(train_datagen.samples) // batch_size
+    if checkpoint is not None:
+        restore_checkpoint(checkpoint, model, sampler, best_checkpoint=cp)
+        print(f'resume from epoch {initial_epoch} step {start_step}')
+    ## full training state every checkpoint_steps steps and after every epoch, written in the background
+    callbacks.append(training_checkpoint(output / 'checkpoint.npz', steps_per_epoch, args.checkpoint_steps,
+                                         seed, sampler, best_checkpoint=cp, start_step=start_step))
+
+    def make_flows(global_step):
+        # training batches from the global step on (not reproducible with tf.data), validation batches from the start
+        if isinstance(train_datagen, multiscale_generator):
+            return train_datagen.flow_from_directory(seed=seed, start_step=global_step), valid_datagen.flow_from_directory(batch_size), []
+        if args.tf_data:
+            # tf.data reads, converts and prefetches the batches in parallel outside the GIL
+            return (train_datagen.build(batch_size, mode='train', seed=seed, uint8=args.uint8_inputs),
+                    valid_datagen.build(batch_size, mode='valid', uint8=args.uint8_inputs), [])
+        if args.workers > 0:
+            # worker processes assemble the batches in shared memory
+            affinity = parse_affinity(args.affinity)
+            loaders = [prefetch_loader(train_datagen, batch_size, workers=args.workers, prefetch=args.prefetch,
+                                       affinity=affinity, start_step=global_step, sampler=sampler),
+                       prefetch_loader(valid_datagen, batch_size, workers=args.workers, prefetch=args.prefetch,
+                                       affinity=affinity)]
+            return loaders[0].flow(), loaders[1].flow(), loaders
+        return (train_datagen.flow_from_directory(batch_size, start_step=global_step, sampler=sampler),
+                valid_datagen.flow_from_directory(batch_size), [])
+
+    if args.accumulation_steps > 1 and not args.compiled_loop:
+        raise Exception('--accumulation_steps needs --compiled_loop.')
+    train_batch_sizes = train_datagen.batch_sizes if isinstance(train_datagen, multiscale_generator) else [batch_size]
+    if any(size % args.accumulation_steps for size in train_batch_sizes):
+        raise Exception(f'the training batch sizes {train_batch_sizes} must be multiples of --accumulation_steps={args.accumulation_steps}.')
+    if args.compiled_loop:
+        # XLA-compiled train step (forward, loss and update), steps_per_execution steps per call
+        trainer = compiled_trainer(model, loss_function, optimizer, steps_per_execution=args.steps_per_execution,
+                                   accumulation_steps=args.accumulation_steps)
+    epoch, step = initial_epoch, start_step
+    while epoch < epochs:
+        # a run resumed within an epoch finishes that epoch in a fit of its own
+        last_epoch = epoch + 1 if step > 0 else epochs
+        train_flow, valid_flow, loaders = make_flows(epoch * steps_per_epoch + step)
+        if args.compiled_loop:
+            trainer.fit(
+                train_flow,
+                steps_per_epoch=steps_per_epoch - step,
+                epochs=last_epoch,
+                initial_epoch=epoch,
+                verbose=1,
+                callbacks=callbacks,
+                validation_data=valid_flow,
+                validation_steps=len(valid_datagen.samples) // batch_size
+            )
+        else:
+            model.fit(
+                train_flow,
+                steps_per_epoch=steps_per_epoch - step,
+                epochs=last_epoch,
+                initial_epoch=epoch,
+                verbose=1,
+                callbacks=callbacks,
+                validation_data=valid_flow,
+                validation_steps=len(valid_datagen.samples) // batch_size,
+                max_queue_size=20
+            )
+        for loader in loaders:
+            loader.close()
+        logger.append = True
+        epoch, step = last_epoch, 0
@@ -6,10 +6,6 @@ from train import train
 
 
 if __name__ == "__main__":
-    # define model
-    model = build_model()
-    print(model.summary())
-
     # args settings
     parser = argparse.ArgumentParser()
     parser.add_argument('--memo', '-m', default='')
@@ -17,7 +13,27 @@ if __name__ == "__main__":
     parser.add_argument('--model_name', default='STCLSTM')
     parser.add_argument('--train_list', default='../patch_data_fl5/train_data.txt')
     parser.add_argument('--valid_list', default='../patch_data_fl5/validation_data.txt')
+    parser.add_argument('--workers', type=int, default=0, help='data loader processes (0: load in the training process)')
+    parser.add_argument('--prefetch', type=int, default=8, help='batches prepared ahead by the data loader processes')
+    parser.add_argument('--affinity', default=None, help="'auto' or cpu lists per loader process, e.g. '0,1:2,3'")
+    parser.add_argument('--tf_data', action='store_true', help='load the data with the tf.data pipeline (mydataset.py)')
+    parser.add_argument('--train_cache_gb', type=float, default=0, help='RAM cache of decoded training samples (GiB)')
+    parser.add_argument('--valid_cache_gb', type=float, default=0, help='RAM cache of decoded validation samples (GiB)')
+    parser.add_argument('--importance_sampling', action='store_true', help='draw training samples in proportion to their loss')
+    parser.add_argument('--score_fraction', type=float, default=0.1, help='share of training samples scored after every epoch')
+    parser.add_argument('--patch_sizes', default='32', help='training crop sizes, e.g. 32,64,128 (other than 32 needs the scene layout)')
+    parser.add_argument('--compiled_loop', action='store_true', help='train with the XLA-compiled training loop (train_loop.py)')
+    parser.add_argument('--steps_per_execution', type=int, default=1, help='training steps per call of the compiled loop')
+    parser.add_argument('--accumulation_steps', type=int, default=1, help='micro-batches per batch, gradients summed into one update (--compiled_loop)')
+    parser.add_argument('--recompute', action='store_true', help='recompute the activations of the 3D conv branches (and the recurrence) in the backward pass')
+    parser.add_argument('--checkpoint_steps', type=int, default=1000, help='steps between checkpoints of the full training state')
+    parser.add_argument('--resume', default=None, help='output directory of an interrupted run to continue from its checkpoint')
+    parser.add_argument('--uint8_inputs', action='store_true', help='feed uint8 images, scaled to [0, 1] in the model')
     args=parser.parse_args()
 
+    # define model
+    model = build_model(uint8_inputs=args.uint8_inputs, recompute=args.recompute)
+    print(model.summary())
+
     # start train
     train(model=model, args=args)
\ No newline at end of file
@@ -0,0 +1,166 @@
+import argparse
+import itertools
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.callbacks import CallbackList
+
+
+def as_dataset(flow):
+    # batches ([h, v], disp[, weights]) of a python flow or ((h, v), disp) of a tf.data pipeline
+    # -> tf.data.Dataset of ((h, v), disp, weights), weights of ones if the flow has none
+    if isinstance(flow, tf.data.Dataset):
+        return flow.map(lambda inputs, disp: (inputs, disp, tf.ones(tf.shape(disp)[:1])))
+    first = next(flow)
+
+    def batches():
+        # copied into tensors as they are yielded, before the flow reuses its buffers
+        for batch in itertools.chain([first], flow):
+            (h, v), disp = batch[:2]
+            weights = batch[2] if len(batch) == 3 else np.ones(len(disp), dtype=np.float32)
+            yield (h, v), disp, weights
+
+    image_type = tf.as_dtype(first[0][0].dtype)
+    # the frame count is fixed for a run, so that the recurrence can be unrolled
+    frames = first[1].shape[1]
+    image_shape = (None, frames, 9, None, None, 3)
+    return tf.data.Dataset.from_generator(batches, ((image_type, image_type), tf.float32, tf.float32),
+                                          ((image_shape, image_shape), (None, frames, None, None), (None,)))
+
+
+class compiled_trainer():
+    # Counterpart of model.fit for a compiled model: the forward pass, the loss and the optimizer update
+    # of a step are compiled by XLA into one function, and steps_per_execution steps run per call
+    # from Python. Keras callbacks get the same calls and logs (loss, val_loss) as from fit.
+    # With accumulation_steps > 1 a batch is split into that many micro-batches run one after the other,
+    # and their gradients are summed into one update, so peak memory is that of a micro-batch.
+    # The batch size must be a multiple of accumulation_steps, so that the micro-batches have one static shape for XLA.
+    # (The branches subtract the mean over the batch, which is then the mean over the micro-batch.)
+    def __init__(self, model, loss_function, optimizer, steps_per_execution=1, accumulation_steps=1):
+        self.model = model
+        self.loss_function = loss_function
+        self.optimizer = optimizer
+        self.steps_per_execution = steps_per_execution
+        self.accumulation_steps = accumulation_steps
+
+        def gradients(inputs, disp, weights):
+            # loss and gradients of a batch, summed over its micro-batches
+            if accumulation_steps == 1:
+                with tf.GradientTape() as tape:
+                    pred = model(inputs, training=True)
+                    # the per-sample loss averaged over the batch as in fit
+                    loss = tf.reduce_mean(loss_function(disp, pred) * weights)
+                return loss, tape.gradient(loss, model.trainable_variables)
+            batch_n = tf.shape(disp)[0]
+
+            def micro_batches(x):
+                # (batch, ...) -> (accumulation_steps, batch / accumulation_steps, ...)
+                return tf.reshape(x, tf.concat([[accumulation_steps, batch_n // accumulation_steps], tf.shape(x)[1:]], axis=0))
+            h, v, disp_micro, weights_micro = [micro_batches(x) for x in [*inputs, disp, weights]]
+            loss = tf.constant(0.0)
+            grads = [tf.zeros_like(var) for var in model.trainable_variables]
+            for i in tf.range(accumulation_steps):
+                with tf.GradientTape() as tape:
+                    pred = model((h[i], v[i]), training=True)
+                    # the micro-batch's share of the mean over the batch
+                    micro_loss = tf.reduce_sum(loss_function(disp_micro[i], pred) * weights_micro[i]) / tf.cast(batch_n, tf.float32)
+                micro_grads = tape.gradient(micro_loss, model.trainable_variables)
+                grads = [grad + micro_grad for grad, micro_grad in zip(grads, micro_grads)]
+                loss += micro_loss
+            return loss, grads
+
+        @tf.function(experimental_compile=True)
+        def train_step(inputs, disp, weights):
+            loss, grads = gradients(inputs, disp, weights)
+            optimizer.apply_gradients(zip(grads, model.trainable_variables))
+            return loss
+
+        @tf.function(experimental_compile=True)
+        def eval_step(inputs, disp, weights):
+            pred = model(inputs, training=False)
+            return tf.reduce_mean(loss_function(disp, pred) * weights)
+
+        @tf.function
+        def run_steps(step, iterator, steps):
+            # sum of the losses of `steps` steps, steps is a tensor so that a shorter last call is not retraced
+            loss_sum = tf.constant(0.0)
+            for _ in tf.range(steps):
+                inputs, disp, weights = next(iterator)
+                loss_sum += step(inputs, disp, weights)
+            return loss_sum
+
+        # compiled as in train_step, for checking the accumulation (see __main__)
+        self.gradients = tf.function(gradients, experimental_compile=True)
+        self.train_step = train_step
+        self.eval_step = eval_step
+        self.run_steps = run_steps
+
+    def evaluate(self, iterator, steps):
+        loss_sum = 0.0
+        for begin in range(0, steps, self.steps_per_execution):
+            n = min(self.steps_per_execution, steps - begin)
+            loss_sum += float(self.run_steps(self.eval_step, iterator, tf.constant(n)))
+        return loss_sum / max(steps, 1)
+
+    def fit(self, train_data, steps_per_epoch, epochs=1, initial_epoch=0, verbose=1, callbacks=None,
+            validation_data=None, validation_steps=None):
+        # train_data, validation_data: python flows or tf.data pipelines (see as_dataset), repeated endlessly
+        train_iterator = iter(as_dataset(train_data))
+        valid_iterator = iter(as_dataset(validation_data)) if validation_data is not None else None
+        callbacks = CallbackList(callbacks, add_history=True, add_progbar=verbose != 0, model=self.model,
+                                 verbose=verbose, epochs=epochs, steps=steps_per_epoch)
+        self.model.stop_training = False
+        callbacks.on_train_begin()
+        for epoch in range(initial_epoch, epochs):
+            callbacks.on_epoch_begin(epoch)
+            loss_sum = 0.0
+            start = time.time()
+            for begin in range(0, steps_per_epoch, self.steps_per_execution):
+                n = min(self.steps_per_execution, steps_per_epoch - begin)
+                callbacks.on_train_batch_begin(begin)
+                loss_sum += float(self.run_steps(self.train_step, train_iterator, tf.constant(n)))
+                callbacks.on_train_batch_end(begin + n - 1, {'loss': loss_sum / (begin + n)})
+            logs = {'loss': loss_sum / max(steps_per_epoch, 1), 'steps_per_sec': steps_per_epoch / (time.time() - start)}
+            if valid_iterator is not None:
+                logs['val_loss'] = self.evaluate(valid_iterator, validation_steps)
+            callbacks.on_epoch_end(epoch, logs)
+            if self.model.stop_training:
+                break
+        callbacks.on_train_end()
+        return self.model.history
+
+
+if __name__ == "__main__":
+    # checks that the summed micro-batch gradients equal the full-batch gradient, on a small model
+    # without the batch-mean subtraction of the branches (which makes micro-batches differ by design)
+    from tensorflow.keras import backend as K
+    from tensorflow.keras.layers import Input, Lambda, Concatenate, Conv2D, TimeDistributed
+    from tensorflow.keras.models import Model
+    from loss import get_loss_function
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--accumulation_steps', type=int, default=4)
+    args=parser.parse_args()
+
+    frames, size = 5, 32
+    input_h = Input(shape=(frames, 9, size, size, 3))
+    input_v = Input(shape=(frames, 9, size, size, 3))
+    x = Concatenate()([Lambda(lambda x: K.mean(x, axis=2))(input_h), Lambda(lambda x: K.mean(x, axis=2))(input_v)])
+    x = TimeDistributed(Conv2D(8, 3, padding='same', activation='relu'))(x)
+    x = TimeDistributed(Conv2D(1, 3, padding='same'))(x)
+    model = Model(inputs=[input_h, input_v], outputs=Lambda(lambda x: x[..., 0])(x))
+
+    rng = np.random.RandomState(0)
+    inputs = [tf.constant(rng.rand(args.batch_size, frames, 9, size, size, 3), tf.float32) for _ in range(2)]
+    disp = tf.constant(rng.randn(args.batch_size, frames, size, size), tf.float32)
+    weights = tf.constant(rng.rand(args.batch_size), tf.float32)
+    results = []
+    for accumulation_steps in [1, args.accumulation_steps]:
+        trainer = compiled_trainer(model, get_loss_function(), None, accumulation_steps=accumulation_steps)
+        loss, grads = trainer.gradients(inputs, disp, weights)
+        results.append((float(loss), [grad.numpy() for grad in grads]))
+    (loss, grads), (accumulated_loss, accumulated_grads) = results
+    print(f'loss {loss:.6f}, accumulated {accumulated_loss:.6f}')
+    print('max gradient difference', max(np.abs(a - b).max() for a, b in zip(grads, accumulated_grads)),
+          'of max gradient', max(np.abs(grad).max() for grad in grads))